@@ -0,0 +1,165 @@
+import argparse
+import glob
+import itertools
+import json
+import re
+import sys
+
+import numpy as np
+from inductor import BartInductor
+from src.data_reader import read_rule_records, set_cache_dir
+from src.model_registry import set_quantize
+from src.tracing import Tracer
+
+PREMISE_FILES = ['data/OpenRule155.txt'] + sorted(glob.glob('data/RE/*.txt'))
+
+STAGES = [
+    'generate',
+    'generate_ins',
+    'filter_words',
+    'extract_templateBs_batch_global_score',
+    'group_beam_search',
+    'DPPsampler.rescoring',
+    'DPPsampler.dpp',
+    'DPPsampler.get_L',
+    'DPPsampler.select',
+    'post_process',
+]
+
+
+def load_premises(files, num_premises):
+    # the same reader as evaluation.py, so the bench sees the premises the evaluation does
+    premises = []
+    for path in files:
+        for record in itertools.islice(read_rule_records(path), num_premises):
+            premises.append(re.sub("<A>|<B>", "<mask>", record.inputs))
+    return premises
+
+
+def memory_mb(record):
+    # CUDA: peak of the stage itself; CPU: the process's high-water mark when the stage ended
+    return record.get('peak_memory_mb', record.get('max_rss_mb', 0.0))
+
+
+class TraceCollector(object):
+    def __init__(self):
+        self.traces = []
+
+    def __call__(self, trace):
+        self.traces.append(trace)
+
+    def summary(self, num_rules):
+        latencies = {}
+        memory = {}
+        counters = {}
+        # the tracer records a per-stage peak on CUDA devices and the process's max RSS on CPU
+        scope = 'stage' if any('peak_memory_mb' in trace for trace in self.traces) else 'process'
+        for trace in self.traces:
+            per_request = {'generate': trace['duration']}
+            for stage in trace['stages']:
+                per_request[stage['name']] = per_request.get(stage['name'], 0.0) + stage['duration']
+                memory[stage['name']] = max(memory.get(stage['name'], 0.0), memory_mb(stage))
+            memory['generate'] = max(memory.get('generate', 0.0), memory_mb(trace))
+            for name, seconds in per_request.items():
+                latencies.setdefault(name, []).append(seconds)
+            for name, value in trace['counters'].items():
+                counters[name] = counters.get(name, 0) + value
+
+        ret = {}
+        for stage, values in latencies.items():
+            latency = np.array(values)
+            ret[stage] = {
+                'calls': len(values),
+                'total_s': float(latency.sum()),
+                'p50_ms': float(np.percentile(latency, 50) * 1000),
+                'p95_ms': float(np.percentile(latency, 95) * 1000),
+                'requests_per_s': len(values) / float(latency.sum()),
+                'rules_per_s': num_rules / float(latency.sum()),
+                'peak_memory_mb': memory.get(stage, 0.0),
+                'memory_scope': scope,
+            }
+        return ret, {name: value / max(len(self.traces), 1) for name, value in counters.items()}
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for stage, stats in results['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+        for metric in ('p50_ms', 'p95_ms'):
+            old = baseline['stages'][stage][metric]
+            new = stats[metric]
+            ratio = new / old if old > 0 else float('inf')
+            flag = ''
+            if ratio > 1 + tolerance:
+                flag = '  <-- regression'
+                regressions.append((stage, metric, ratio))
+            print('{:<40} {:<7} {:>10.1f} -> {:>10.1f} ms  x{:.2f}{}'.format(stage, metric, old, new, ratio, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default='0')
+    parser.add_argument("--files", type=str, nargs='+', default=PREMISE_FILES)
+    parser.add_argument("--data_cache", type=str, default=None, help="directory for parsed copies of the data files, see src/data_reader.py")
+    parser.add_argument("--num_premises", type=int, default=10, help="premises taken from the top of each file")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--topk", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=None, help="seed every request so runs produce the same rules")
+    parser.add_argument("--rescore", action='store_true', help="rerank hypotheses with GPT-2 before DPP")
+    parser.add_argument("--instance_streams", type=int, default=0, help="sample instance_streams * k instances instead of beam sampling")
+    parser.add_argument("--adaptive_decoding", action='store_true', help="retire hypothesis beam groups once they emit EOS")
+    parser.add_argument("--decode_budget", type=int, default=None, help="cap on instances * hypothesis beams per premise")
+    parser.add_argument("--share_prefix", action='store_true', help="decode beams with identical prefixes once per step")
+    parser.add_argument("--quantize", action='store_true', help="int8 dynamic quantization of the models (CPU only)")
+    parser.add_argument("--export_dir", type=str, default=None, help="run group beam search on the graphs exported by src/graph_export.py (CPU only)")
+    parser.add_argument("--output", type=str, default='bench_results.json')
+    parser.add_argument("--baseline", type=str, default=None, help="previous --output file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative slowdown before flagging")
+    args = parser.parse_args()
+
+    if args.quantize:
+        set_quantize(True)
+    if args.data_cache is not None:
+        set_cache_dir(args.data_cache)
+    device = args.device if args.device == 'cpu' else 'cuda:' + args.device
+    premises = load_premises(args.files, args.num_premises)
+    collector = TraceCollector()
+    inductor = BartInductor(device=device, rescore=args.rescore,
+                             instance_streams=args.instance_streams, adaptive_decoding=args.adaptive_decoding,
+                             decode_budget=args.decode_budget, share_prefix=args.share_prefix, export_dir=args.export_dir,
+                             tracer=Tracer(sink=collector, device=device, memory=True))
+
+    for premise in premises[:args.warmup]:
+        inductor.generate(premise, k=args.k, topk=args.topk, seed=args.seed)
+    collector.traces = []
+
+    num_rules = 0
+    for premise in premises:
+        num_rules += len(inductor.generate(premise, k=args.k, topk=args.topk, seed=args.seed))
+
+    stages, counters = collector.summary(num_rules)
+    results = {
+        'config': vars(args),
+        'num_premises': len(premises),
+        'num_rules': num_rules,
+        'stages': stages,
+        'counters_per_request': counters,
+    }
+    for stage in STAGES:
+        if stage in results['stages']:
+            stats = results['stages'][stage]
+            print('{:<40} p50 {:>9.1f} ms  p95 {:>9.1f} ms  {:>8.2f} rules/s  {} {:>8.0f} MB'.format(
+                stage, stats['p50_ms'], stats['p95_ms'], stats['rules_per_s'],
+                'peak' if stats['memory_scope'] == 'stage' else 'max rss', stats['peak_memory_mb']))
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
@@ -1,20 +1,89 @@
+import os
 import torch
+import torch.nn.functional as F
 import numpy as np
 from dpp.dpp import dpp
 from transformers import BertModel, BertTokenizer, GPT2LMHeadModel, GPT2Tokenizer
-from sklearn.cluster import KMeans, AgglomerativeClustering
+from sklearn.cluster import KMeans, MiniBatchKMeans, AgglomerativeClustering
+from src.dedup import EmbeddingCache, semantic_dedup
+from src.model_registry import get_model, get_tokenizer
+from src.seeding import seeded
+from src.tracing import NULL_TRACER
+
+PROJECTION_NAME = 'projection.pt'
+
+def greedy_map(diag, C, max_length, epsilon=1E-10):
+    """Fast greedy MAP inference for the kernel ``K = diag(diag) + C C^T``, given only its factors.
+
+    Same algorithm as ``dpp.dpp.dpp`` (incremental Cholesky updates of the
+    selected set), but each selected row of K is computed on the fly from C,
+    so time and memory are O(N * (d + max_length)) instead of O(N^2).
+    """
+    di2s = diag + (C * C).sum(dim=1)
+    cis = C.new_zeros((max_length, C.size(0)))
+    selected_item = int(torch.argmax(di2s))
+    selected_items = [selected_item]
+    while len(selected_items) < max_length:
+        k = len(selected_items) - 1
+        elements = torch.matmul(C, C[selected_item])
+        elements[selected_item] += diag[selected_item]
+        eis = (elements - torch.matmul(cis[:k, selected_item], cis[:k])) / torch.sqrt(di2s[selected_item])
+        cis[k] = eis
+        di2s -= eis ** 2
+        di2s[selected_item] = -float('inf')
+        selected_item = int(torch.argmax(di2s))
+        if di2s[selected_item] < epsilon:
+            break
+        selected_items.append(selected_item)
+    return selected_items
+
 
 class DPPsampler():
 
-    def __init__(self, device, model_dir=None):
+    def __init__(self, device, model_dir=None, tracer=None, quantize=None):
 
         self.device = device
+        self.tracer = tracer if tracer is not None else NULL_TRACER
         self.model_name = 'bert-base-uncased' if model_dir is None else model_dir
         self.rescorer_name = "gpt2"
-        self.tokenizer = BertTokenizer.from_pretrained(self.model_name)
-        self.model = BertModel.from_pretrained(self.model_name).eval().cuda(self.device)
-        self.rescorer_tokenizer = GPT2Tokenizer.from_pretrained(self.rescorer_name)
-        self.rescorer = GPT2LMHeadModel.from_pretrained(self.rescorer_name).eval().cuda(self.device)
+        self.quantize = quantize
+        # BERT and GPT-2 are loaded on first use; the rescorer is only needed by rescoring()
+        self._tokenizer = None
+        self._model = None
+        self._rescorer_tokenizer = None
+        self._rescorer = None
+        self.embedding_cache = EmbeddingCache(self.embed)
+        # optional linear head over the pooled representation, trained by train_dpp.py --freeze head
+        self.projection = None
+        if model_dir is not None and os.path.isfile(os.path.join(model_dir, PROJECTION_NAME)):
+            state = torch.load(os.path.join(model_dir, PROJECTION_NAME), map_location='cpu')
+            self.projection = torch.nn.Linear(state['weight'].size(1), state['weight'].size(0))
+            self.projection.load_state_dict(state)
+            self.projection = self.projection.eval().to(device)
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            self._tokenizer = get_tokenizer(BertTokenizer, self.model_name)
+        return self._tokenizer
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = get_model(BertModel, self.model_name, self.device, quantize=self.quantize)
+        return self._model
+
+    @property
+    def rescorer_tokenizer(self):
+        if self._rescorer_tokenizer is None:
+            self._rescorer_tokenizer = get_tokenizer(GPT2Tokenizer, self.rescorer_name)
+        return self._rescorer_tokenizer
+
+    @property
+    def rescorer(self):
+        if self._rescorer is None:
+            self._rescorer = get_model(GPT2LMHeadModel, self.rescorer_name, self.device)
+        return self._rescorer
 
     def tokenize(self, sents, tokenizer):
         ids = []
@@ -30,14 +99,15 @@ class DPPsampler():
 
     def get_repr(self, sents):
         ids = self.tokenize(sents, self.tokenizer)
-        ids = torch.tensor(ids).cuda(self.device)
+        ids = torch.tensor(ids).to(self.device)
         repr = self.model(ids)[0]
+        self.tracer.count('model_calls.dpp_encoder')
         repr = torch.mean(repr, dim=1)
         return repr
 
-    def Kmeans_clusting(self, sents, n_clusters=5):
+    def Kmeans_clusting(self, sents, n_clusters=5, random_state=None):
         repr = self.get_repr(sents)
-        kmeans = KMeans(n_clusters=n_clusters)
+        kmeans = KMeans(n_clusters=n_clusters, random_state=random_state)
         result = kmeans.fit(repr.detach().cpu().numpy())
         return result.labels_
 
@@ -47,35 +117,203 @@ class DPPsampler():
         result = clustering.fit(repr.detach().cpu().numpy())
         return result.labels_
 
-    def get_L(self, sents):
-        repr_raw = self.get_repr(sents)
+    def embed(self, sents, batch_size=256):
+        """Mean-pooled BERT vectors computed in chunks of ``batch_size``.
+
+        Unlike ``get_repr`` (whose output the DPP kernel depends on), padding is
+        masked out of both attention and pooling, so a sentence gets the same
+        vector whatever it is batched with.
+        """
+        ret = []
+        with torch.no_grad():
+            for start in range(0, len(sents), batch_size):
+                batch = self.tokenizer([sent[0] for sent in sents[start:start + batch_size]], padding=True, return_tensors='pt')
+                mask = batch['attention_mask'].to(self.device)
+                hidden = self.model(batch['input_ids'].to(self.device), attention_mask=mask)[0]
+                self.tracer.count('model_calls.dpp_encoder')
+                mask = mask.unsqueeze(-1).to(hidden.dtype)
+                ret.append((hidden * mask).sum(dim=1) / mask.sum(dim=1))
+        return torch.cat(ret, dim=0)
+
+    def dedup(self, sents, threshold=0.9):
+        """Indices of ``sents`` left after dropping lower-scored near-duplicates (cosine >= ``threshold``)."""
+        vectors = self.embedding_cache.get([sent[0] for sent in sents])
+        keep = semantic_dedup(vectors, [sent[1] for sent in sents], threshold)
+        self.tracer.count('dedup.removed', len(sents) - len(keep))
+        return keep
+
+    def reduce(self, repr, dim, method='pca', random_state=None):
+        if dim is None or dim >= min(repr.shape):
+            return repr
+        if method == 'pca':
+            centered = repr - repr.mean(dim=0, keepdim=True)
+            # pca_lowrank is randomized, so seed it like the rest of the request
+            with seeded(random_state, self.device):
+                _, _, v = torch.pca_lowrank(centered, q=dim, center=False)
+            return torch.matmul(centered, v)
+        if method == 'random':
+            generator = torch.Generator()
+            if random_state is not None:
+                generator.manual_seed(random_state)
+            projection = torch.randn(repr.size(1), dim, generator=generator) / dim ** 0.5
+            return torch.matmul(repr, projection.to(repr.device, repr.dtype))
+        raise ValueError('unknown reduction {}'.format(method))
+
+    def torch_kmeans(self, repr, n_clusters, n_iter=50, tol=1e-4, random_state=None, chunk_size=4096):
+        """k-means++ and Lloyd iterations on ``repr``'s device; assignments are computed ``chunk_size`` rows at a time."""
+        generator = torch.Generator()
+        if random_state is not None:
+            generator.manual_seed(random_state)
+        # k-means++ seeding: each new center is drawn proportionally to the squared distance to the closest one
+        first = torch.randint(repr.size(0), (1,), generator=generator).item()
+        centers = repr[first:first + 1]
+        closest = torch.cdist(repr, centers).pow(2).squeeze(1)
+        for _ in range(1, n_clusters):
+            weights = closest.cpu().double()
+            index = torch.multinomial(weights / weights.sum(), 1, generator=generator).item() if weights.sum() > 0 else 0
+            centers = torch.cat([centers, repr[index:index + 1]])
+            closest = torch.min(closest, torch.cdist(repr, repr[index:index + 1]).pow(2).squeeze(1))
+        for _ in range(n_iter):
+            labels = torch.cat([torch.cdist(repr[start:start + chunk_size], centers).argmin(dim=1)
+                                for start in range(0, repr.size(0), chunk_size)])
+            sums = torch.zeros_like(centers).index_add_(0, labels, repr)
+            counts = torch.bincount(labels, minlength=n_clusters).unsqueeze(1)
+            # empty clusters keep their previous center
+            new_centers = torch.where(counts > 0, sums / counts.clamp(min=1), centers)
+            shift = (new_centers - centers).norm(dim=1).max().item()
+            centers = new_centers
+            if shift < tol:
+                break
+        return labels.cpu().numpy()
+
+    def cluster(self, sents, n_clusters=5, method='minibatch', dim=None, reduction='pca', random_state=None):
+        """Cluster ``sents`` on L2-normalized embeddings, optionally reduced to ``dim`` dimensions.
+
+        ``method`` is one of 'minibatch' (sklearn MiniBatchKMeans), 'torch'
+        (k-means on the sampler's device), 'kmeans' or 'agglomerative'; the
+        last one needs O(n^2) memory and is only meant for small pools.
+        """
+        if len(sents) <= n_clusters:
+            return np.arange(len(sents))
+        with self.tracer.stage('DPPsampler.cluster'):
+            repr = F.normalize(self.embed(sents).float(), dim=1)
+            repr = self.reduce(repr, dim, reduction, random_state)
+            if method == 'torch':
+                return self.torch_kmeans(repr, n_clusters, random_state=random_state)
+            repr = repr.cpu().numpy()
+            if method == 'minibatch':
+                clustering = MiniBatchKMeans(n_clusters=n_clusters, batch_size=1024, n_init=3, random_state=random_state)
+            elif method == 'kmeans':
+                clustering = KMeans(n_clusters=n_clusters, random_state=random_state)
+            elif method == 'agglomerative':
+                clustering = AgglomerativeClustering(n_clusters=n_clusters)
+            else:
+                raise ValueError('unknown clustering method {}'.format(method))
+            return clustering.fit(repr).labels_
+
+    def get_features(self, sents):
+        """Factors of the quality-diversity kernel L = B B^T + diag(s - s^2).
+
+        B holds the normalized representations scaled row-wise by the scores s,
+        so L_ij = s_i s_j cos(i, j) off the diagonal and L_ii = s_i.
+        """
+        scores = torch.tensor([sent[1] for sent in sents]).to(self.device)
+        #scores = torch.tensor([1 for sent in sents]).to(self.device)
+        return self.kernel_features(self.get_repr(sents), scores)
+
+    def kernel_features(self, repr_raw, scores):
+        if self.projection is not None:
+            repr_raw = self.projection(repr_raw.to(self.projection.weight.dtype))
         repr_norm = repr_raw/torch.norm(repr_raw, dim=1, keepdim=True)
-        scores = torch.tensor([sent[1] for sent in sents]).cuda(self.device)
-        #scores = torch.tensor([1 for sent in sents]).cuda(self.device)
-        repr = torch.matmul(torch.diag(scores.to(repr_norm.dtype)), repr_norm)
-        L_raw = torch.matmul(repr, repr.T)
-        L_diag = torch.diag(scores-L_raw.diag())
-        L = L_raw + L_diag
+        scores = scores.to(repr_norm.dtype)
+        return repr_norm * scores.unsqueeze(1), scores
+
+    def get_L(self, sents):
+        B, scores = self.get_features(sents)
+        L = torch.matmul(B, B.T)
+        # rows of B have norm s_i, so this is L_raw + diag(s - diag(L_raw))
+        L.diagonal().copy_(scores)
         #print(L)
         return L
 
-    def dpp(self, sents, k):
-        L = self.get_L(sents)
-        lam, v = torch.linalg.eigh(L)
-        #invlam = lam/(1+lam)
-        K = torch.matmul(torch.linalg.inv(L+torch.eye(lam.shape[0]).cuda(self.device)), L)
-        selected_ids = dpp(K.detach().cpu().numpy(), max_length=k)
+    def get_low_rank_K(self, sents):
+        """Marginal kernel K = I - (L + I)^-1 as diag(d) + C C^T, without forming an N x N matrix.
+
+        With L + I = diag(a) + B B^T and a = 1 + s - s^2, Woodbury gives
+        (L + I)^-1 = diag(1/a) - (B/a) M^-1 (B/a)^T for M = I + B^T diag(1/a) B,
+        so d = 1 - 1/a and C = (B/a) chol(M)^-T.
+        """
+        B, scores = self.get_features(sents)
+        B = B.double()
+        scores = scores.double()
+        a = 1 + scores - scores ** 2
+        AinvB = B / a.unsqueeze(1)
+        M = torch.eye(B.size(1), dtype=B.dtype, device=B.device) + torch.matmul(B.T, AinvB)
+        chol = torch.linalg.cholesky(M)
+        C = torch.triangular_solve(AinvB.T, chol, upper=False)[0].T
+        return 1 - 1 / a, C
+
+    def dpp(self, sents, k, low_rank=None):
+        """Greedy MAP selection of at most ``k`` sents.
+
+        ``low_rank`` (default: when there are more candidates than embedding
+        dimensions) selects from the N x d factorization instead of the dense
+        N x N kernel.
+        """
+        if low_rank is None:
+            low_rank = len(sents) > self.model.config.hidden_size
+        if low_rank:
+            with self.tracer.stage('DPPsampler.get_L'):
+                diag, C = self.get_low_rank_K(sents)
+            with self.tracer.stage('DPPsampler.select'):
+                selected_ids = greedy_map(diag, C, k)
+        else:
+            with self.tracer.stage('DPPsampler.get_L'):
+                L = self.get_L(sents)
+            with self.tracer.stage('DPPsampler.select'):
+                #invlam = lam/(1+lam)
+                K = torch.matmul(torch.linalg.inv(L+torch.eye(L.shape[0]).to(self.device)), L)
+                selected_ids = dpp(K.detach().cpu().numpy(), max_length=k)
+        self.tracer.count('dpp.candidates', len(sents))
         return selected_ids
 
-    def rescoring(self, rhs_ls):
-        scores = []
-        for r in rhs_ls:
-            sentence = r[0]
-            inputs = self.rescorer_tokenizer.encode(sentence, return_tensors='pt').cuda(self.device)
-            score = self.rescorer(inputs, labels=inputs)[0]
-            scores.append(np.exp(-score.tolist()))
-            #r.append(score)
-        return scores
+    def rescoring_loglik(self, rhs_ls, batch_size=32):
+        """Return per-sentence (summed GPT-2 log-likelihood, number of scored tokens).
+
+        Sentences are sorted by length and scored in right-padded batches; padded
+        positions are masked out of the sum, so results match scoring each
+        sentence on its own.
+        """
+        ids = [self.rescorer_tokenizer.encode(r[0]) for r in rhs_ls]
+        order = sorted(range(len(ids)), key=lambda i: len(ids[i]))
+        ret = [(0.0, 0)] * len(ids)
+        for start in range(0, len(order), batch_size):
+            batch = [i for i in order[start:start + batch_size] if len(ids[i]) > 1]
+            if len(batch) == 0:
+                continue
+            max_len = max(len(ids[i]) for i in batch)
+            inputs = torch.full((len(batch), max_len), self.rescorer_tokenizer.eos_token_id, dtype=torch.long)
+            mask = torch.zeros((len(batch), max_len), dtype=torch.long)
+            for j, i in enumerate(batch):
+                inputs[j, :len(ids[i])] = torch.tensor(ids[i])
+                mask[j, :len(ids[i])] = 1
+            inputs = inputs.to(self.device)
+            mask = mask.to(self.device)
+
+            logits = self.rescorer(inputs, attention_mask=mask)[0]
+            self.tracer.count('model_calls.rescorer')
+            # token t is predicted from position t-1, as with labels=inputs
+            nll = F.cross_entropy(logits[:, :-1].float().transpose(1, 2), inputs[:, 1:], reduction='none')
+            target_mask = mask[:, 1:].to(nll.dtype)
+            logliks = (-nll * target_mask).sum(dim=1).tolist()
+            counts = target_mask.sum(dim=1).long().tolist()
+            for j, i in enumerate(batch):
+                ret[i] = (logliks[j], counts[j])
+        return ret
+
+    def rescoring(self, rhs_ls, batch_size=32):
+        # exp of the mean token log-likelihood, i.e. exp(-loss) of GPT-2 with labels=inputs
+        return [np.exp(loglik / max(count, 1)) for loglik, count in self.rescoring_loglik(rhs_ls, batch_size)]
 
 if __name__ == "__main__":
     sampler = DPPsampler(0)
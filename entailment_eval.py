@@ -1,20 +1,22 @@
 import torch
 from transformers import BartForSequenceClassification, BartTokenizer
+from src.model_registry import get_model, get_tokenizer
+
+ENTAILMENT_MODEL = "geckos/bart-fined-tuned-on-entailment-classification"
 
 def postprocess(r):
     return r.replace('<mask>', 'A', 1).replace('<mask>', 'B', 1)
 
 class EntailmentScorer():
     
-    def __init__(self, device):
+    def __init__(self, device, quantize=None):
         self.device = device
-        self.model = BartForSequenceClassification.from_pretrained("geckos/bart-fined-tuned-on-entailment-classification").eval().cuda(device)
-        self.tokenizer = BartTokenizer.from_pretrained("geckos/bart-fined-tuned-on-entailment-classification")
+        self.model = get_model(BartForSequenceClassification, ENTAILMENT_MODEL, device, quantize=quantize)
+        self.tokenizer = get_tokenizer(BartTokenizer, ENTAILMENT_MODEL)
     
     def scoring(self, r_p, r_h):
         sentence = postprocess(r_p) + ' ' + postprocess(r_h)
-        ids = self.tokenizer.encode(sentence, return_tensors='pt').cuda(self.device)
+        ids = self.tokenizer.encode(sentence, return_tensors='pt').to(self.device)
         res = self.model(ids) # [contradiction, neutral, entailment]
         probs = torch.softmax(res[0], dim=-1)
         return probs[0][2].tolist()
-
@@ -1,5 +1,8 @@
 import argparse
+import gc
+import itertools
 import logging
+import multiprocessing
 import re
 from datetime import datetime
 import os
@@ -12,10 +15,12 @@ from tqdm import tqdm
 from src.distinct_n.distinct_n.metrics import distinct_n_corpus_level as distinct_n
 from entailment_eval import EntailmentScorer
 from inductor import BartInductor, CometInductor
+from src.data_reader import read_rule_records, set_cache_dir
+from src.model_registry import set_checkpoint_dir, set_quantize
+
+logger = logging.getLogger(__name__)
 
 FILES = {
-    'amie-yago2': 'data/RE-datasets/AMIE-yago2.txt',
-    'rules-yago2': 'data/RE-datasets/RuLES-yago2.txt',
     "openrule155": "data/OpenRule155.txt",
     'fewrel': 'data/RE/fewrel-5.txt',
     'semeval': 'data/RE/semeval-5.txt',
@@ -40,10 +45,24 @@ def rouge(references, hypothesis):
     return max(scores)
 
 
+# set in the parent before forking so workers reuse its already-loaded models
+_worker_evaluator = None
+
+
+def _init_worker(workers):
+    torch.set_num_threads(max(1, os.cpu_count() // workers))
+
+
+def _evaluate_shard(shard):
+    # every worker streams the file itself and keeps rows index, index + workers, ...
+    path, index, workers = shard
+    return _worker_evaluator.evaluate_rows(itertools.islice(read_rule_records(path), index, None, workers))
+
+
 class RelationExtractionEvaluator(object):
     def __init__(self, args):
         self.args = args
-        self.device = 'cuda:' + self.args.device
+        self.device = self.args.device if self.args.device == 'cpu' else 'cuda:' + self.args.device
         self.entailment_scorer = EntailmentScorer(self.device)
         if self.args.inductor == 'rule':
             self.inductor = BartInductor(
@@ -83,7 +102,35 @@ class RelationExtractionEvaluator(object):
         ret = np.mean(bleus)
         return ret
     
-    def evaluate(self, task):
+    def references(self, record):
+        inputs = record.inputs
+        if record.is_list:
+            inputs = re.sub("<A>|<B>", "<mask>", inputs)
+            references = [relation.replace('<A>', '<mask>').replace('<B>', '<mask>').lower().strip() for relation in record.relations]
+        else:
+            references = [record.relations[0].replace('[X]', '<mask>').replace('[Y]', '<mask>').lower().strip()]
+        return inputs, self.clean_references(references)
+
+    def evaluate(self, task, workers=1):
+        if workers > 1:
+            # Forked workers share the parent's model weights copy-on-write, so N workers cost
+            # roughly one copy. CUDA cannot be used after fork, hence CPU only.
+            if self.device != 'cpu':
+                raise ValueError("--workers > 1 requires --device cpu")
+            global _worker_evaluator
+            _worker_evaluator = self
+            if self.args.inductor == 'rule':
+                self.inductor.warmup()
+            gc.freeze()
+            with multiprocessing.get_context('fork').Pool(workers, initializer=_init_worker, initargs=(workers,)) as pool:
+                results = pool.map(_evaluate_shard, [(FILES[task], i, workers) for i in range(workers)])
+            self.metrics = {k: sum([r[k] for r in results], []) for k in results[0].keys()}
+        else:
+            self.metrics = self.evaluate_rows(read_rule_records(FILES[task]))
+
+        self.print(task, self.metrics)
+
+    def evaluate_rows(self, data):
         with torch.no_grad():
             self.metrics = {
                 "bleu-4": [],
@@ -97,170 +144,148 @@ class RelationExtractionEvaluator(object):
                 "entailment score(mean-min)": [],
                 "self-BLEU-2": [],
             }
-            with open(FILES[task], 'r', encoding='utf-8') as file:
-                data = file.readlines()
-                with tqdm(total=len(data)) as pbar:
-                    for row in data:
-                        pbar.update(1)
-                        row = row.strip().split('\t')
-                        inputs, head, tail, relations = row[0], row[1], row[2], row[3]
-                        inputs = inputs.strip()
-                        
-                        if relations.startswith('[') and relations.endswith(']'):
-                            inputs = re.sub("<A>|<B>", "<mask>", inputs)
-                            references = [relation.replace('<A>', '<mask>').replace('<B>', '<mask>').lower().strip() for relation in eval(relations)]
-                        else:
-                            references = [relations.replace('[X]', '<mask>').replace('[Y]', '<mask>').lower().strip()]
-                        references = self.clean_references(references)
-                        hypothesis = self.inductor.generate(inputs, k=10, topk=10)
-                            
-                        logger.info("***********Input************")
-                        logger.info(inputs)
-                        logger.info("*********Hypothesis*********")
-                        for i, hypo in enumerate(hypothesis):
-                            hypothesis[i] = self.clean(hypo.lower().strip())
-                            logger.info(hypo)
-
-                        logger.info("****************************")
-                        logger.info("*********References*********")
-                        logger.info(references)
-                        logger.info("****************************")
+            with tqdm() as pbar:
+                for record in data:
+                    pbar.update(1)
+                    inputs, references = self.references(record)
+                    hypothesis = self.inductor.generate(inputs, k=10, topk=10)
                         
-                        if len(hypothesis) == 0:
-                            for k in self.metrics.keys():
-                                if k != 'self-BLEU-2':
-                                    self.metrics[k].append(0.)
-
-                        else:
-                            entailment_scores = []
-                            for hypo in hypothesis:
-                                try:
-                                    self.metrics['bleu-4'].append(
-                                        bleu(
-                                            [reference.split() for reference in references],
-                                            hypo.split(),
-                                            weights=(0.25, 0.25, 0.25, 0.25)
-                                        )
-                                    )
-                                except Exception:
-                                    logger.warning("Skip bleu-4 in example: {}".format(inputs))
-                                    pass
-
-                                try:
-                                    self.metrics['bleu-3'].append(
-                                        bleu(
-                                            [reference.split() for reference in references],
-                                            hypo.split(),
-                                            weights=(1 / 3, ) * 3
-                                        )
-                                    )
-                                except Exception:
-                                    logger.warning("Skip bleu-3 in example: {}".format(inputs))
-                                    pass
-
-                                try:
-                                    self.metrics['bleu-2'].append(
-                                        bleu(
-                                            [reference.split() for reference in references],
-                                            hypo.split(),
-                                            weights=(0.5, 0.5)
-                                        )           
-                                    )
-                                except Exception:
-                                    logger.warning("Skip bleu-2 in example: {}".format(inputs))
-                                    pass
-
-                                try:
-                                    self.metrics['bleu-1'].append(
-                                        bleu(
-                                            [reference.split() for reference in references],
-                                            hypo.split(),
-                                            weights=(1.0, )
-                                        )
+                    logger.info("***********Input************")
+                    logger.info(inputs)
+                    logger.info("*********Hypothesis*********")
+                    for i, hypo in enumerate(hypothesis):
+                        hypothesis[i] = self.clean(hypo.lower().strip())
+                        logger.info(hypo)
+
+                    logger.info("****************************")
+                    logger.info("*********References*********")
+                    logger.info(references)
+                    logger.info("****************************")
+                    
+                    if len(hypothesis) == 0:
+                        for k in self.metrics.keys():
+                            if k != 'self-BLEU-2':
+                                self.metrics[k].append(0.)
+
+                    else:
+                        entailment_scores = []
+                        for hypo in hypothesis:
+                            try:
+                                self.metrics['bleu-4'].append(
+                                    bleu(
+                                        [reference.split() for reference in references],
+                                        hypo.split(),
+                                        weights=(0.25, 0.25, 0.25, 0.25)
                                     )
-                                except Exception:
-                                    logger.warning("Skip bleu-1 in example: {}".format(inputs))
-                                    pass
-
-                                try:
-                                    self.metrics['METEOR'].append(
-                                        meteor(
-                                            references,
-                                            hypo,
-                                        )
+                                )
+                            except Exception:
+                                logger.warning("Skip bleu-4 in example: {}".format(inputs))
+                                pass
+
+                            try:
+                                self.metrics['bleu-3'].append(
+                                    bleu(
+                                        [reference.split() for reference in references],
+                                        hypo.split(),
+                                        weights=(1 / 3, ) * 3
                                     )
-                                except:
-                                    logger.warning("Skip METEOR in example: {}".format(inputs))
-                                    pass
-                                    
-
-                                try:
-                                    self.metrics['ROUGE-L'].append(
-                                        rouge(
-                                            references,
-                                            hypo,
-                                        )
+                                )
+                            except Exception:
+                                logger.warning("Skip bleu-3 in example: {}".format(inputs))
+                                pass
+
+                            try:
+                                self.metrics['bleu-2'].append(
+                                    bleu(
+                                        [reference.split() for reference in references],
+                                        hypo.split(),
+                                        weights=(0.5, 0.5)
+                                    )           
+                                )
+                            except Exception:
+                                logger.warning("Skip bleu-2 in example: {}".format(inputs))
+                                pass
+
+                            try:
+                                self.metrics['bleu-1'].append(
+                                    bleu(
+                                        [reference.split() for reference in references],
+                                        hypo.split(),
+                                        weights=(1.0, )
                                     )
-                                except:
-                                    logger.warning("Skip ROUGE-L in example: {}".format(inputs))
-                                    pass
+                                )
+                            except Exception:
+                                logger.warning("Skip bleu-1 in example: {}".format(inputs))
+                                pass
 
-                                
-                                try:
-                                    entailment_score = self.entailment_scorer.scoring(inputs, hypo)
-                                    self.metrics['entailment score(mean-mean)'].append(entailment_score)
-                                    entailment_scores.append(entailment_score)
-                                except:
-                                    logger.warning("Skip entailment score in example: {}".format(inputs))
-                                    pass
-                                
                             try:
-                                self.metrics['entailment score(mean-max)'].append(max(entailment_scores))
-                                self.metrics['entailment score(mean-min)'].append(min(entailment_scores))
+                                self.metrics['METEOR'].append(
+                                    meteor(
+                                        references,
+                                        hypo,
+                                    )
+                                )
                             except:
-                                logger.warning("Skip entailment score in example: {}.".format(inputs))
+                                logger.warning("Skip METEOR in example: {}".format(inputs))
                                 pass
+                                
 
                             try:
-                                self.metrics['self-BLEU-2'].append(
-                                    self.self_bleu(
-                                        hypothesis,
+                                self.metrics['ROUGE-L'].append(
+                                    rouge(
+                                        references,
+                                        hypo,
                                     )
                                 )
                             except:
-                                logger.warning("Skip self-bleu-2 in example: {}.".format(inputs))
+                                logger.warning("Skip ROUGE-L in example: {}".format(inputs))
                                 pass
-                        # break
 
-            self.print(task, self.metrics)
+                            
+                            try:
+                                entailment_score = self.entailment_scorer.scoring(inputs, hypo)
+                                self.metrics['entailment score(mean-mean)'].append(entailment_score)
+                                entailment_scores.append(entailment_score)
+                            except:
+                                logger.warning("Skip entailment score in example: {}".format(inputs))
+                                pass
+                            
+                        try:
+                            self.metrics['entailment score(mean-max)'].append(max(entailment_scores))
+                            self.metrics['entailment score(mean-min)'].append(min(entailment_scores))
+                        except:
+                            logger.warning("Skip entailment score in example: {}.".format(inputs))
+                            pass
+
+                        try:
+                            self.metrics['self-BLEU-2'].append(
+                                self.self_bleu(
+                                    hypothesis,
+                                )
+                            )
+                        except:
+                            logger.warning("Skip self-bleu-2 in example: {}.".format(inputs))
+                            pass
+                    # break
+
+            return self.metrics
 
     def eval_references(self, task):
         with torch.no_grad():
             entailment_score = []
-            with open(FILES[task], 'r', encoding='utf-8') as file:
-                data = file.readlines()
-                with tqdm(total=len(data)) as pbar:
-                    for row in data:
-                        pbar.update(1)
-                        row = row.strip().split('\t')
-                        inputs, head, tail, relations = row[0], row[1], row[2], row[3]
-                        inputs = inputs.strip()
-                        
-                        if relations.startswith('[') and relations.endswith(']'):
-                            inputs = re.sub("<A>|<B>", "<mask>", inputs)
-                            references = [relation.replace('<A>', '<mask>').replace('<B>', '<mask>').lower().strip() for relation in eval(relations)]
-                        else:
-                            references = [relations.replace('[X]', '<mask>').replace('[Y]', '<mask>').lower().strip()]
-                        references = self.clean_references(references)
-                            
-                        logger.info("***********Input************")
-                        logger.info(inputs)
-                        logger.info("*********References*********")
-                        logger.info(references)
-                        logger.info("****************************")
-                        
-                        for ref in references:
-                            entailment_score.append(self.entailment_scorer.scoring(inputs, ref))
+            with tqdm() as pbar:
+                for record in read_rule_records(FILES[task]):
+                    pbar.update(1)
+                    inputs, references = self.references(record)
+
+                    logger.info("***********Input************")
+                    logger.info(inputs)
+                    logger.info("*********References*********")
+                    logger.info(references)
+                    logger.info("****************************")
+                    
+                    for ref in references:
+                        entailment_score.append(self.entailment_scorer.scoring(inputs, ref))
             
             logger.info("reference entailment score: {}".format(str(np.mean(entailment_score))))
 
@@ -289,8 +314,19 @@ if __name__ == '__main__':
     parser.add_argument("--log_dir", type=str, default='logs_new_new_new/')
     parser.add_argument("--log_name", type=str, default='default_log')
     parser.add_argument("--device", type=str, default='0')
+    parser.add_argument("--workers", type=int, default=1, help="forked CPU evaluation workers sharing one copy of the models")
+    parser.add_argument("--checkpoint_dir", type=str, default=None, help="directory of safetensors exports, see src/model_registry.py")
+    parser.add_argument("--data_cache", type=str, default=None, help="directory for parsed copies of the data files, see src/data_reader.py")
+    parser.add_argument("--quantize", action='store_true', help="int8 dynamic quantization of all models (CPU only), see quantization_check.py")
     args = parser.parse_args()
 
+    if args.checkpoint_dir is not None:
+        set_checkpoint_dir(args.checkpoint_dir)
+    if args.quantize:
+        set_quantize(True)
+    if args.data_cache is not None:
+        set_cache_dir(args.data_cache)
+
     if not os.path.exists(args.log_dir):
         os.mkdir(args.log_dir)
 
@@ -299,7 +335,6 @@ if __name__ == '__main__':
         format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
         datefmt='%m/%d/%Y %H:%M:%S',
         level=logging.INFO)
-    logger = logging.getLogger(__name__)
 
 
     def print_config(config):
@@ -314,5 +349,5 @@ if __name__ == '__main__':
 
     print_config(args)
     evaluator = RelationExtractionEvaluator(args)
-    evaluator.evaluate(args.task)
+    evaluator.evaluate(args.task, args.workers)
     #evaluator.eval_references(args.task)
@@ -13,6 +13,7 @@ from tqdm import tqdm
 from transformers import (AutoConfig, AutoModel,
                           AutoModelForSequenceClassification, AutoTokenizer,
                           BertForSequenceClassification, BertModel)
+from src.data_reader import read_re_examples
 
 if not os.path.exists('logs/'):
     os.mkdir('logs/')
@@ -99,17 +100,14 @@ class REDataset(Dataset):
         self.sentences = []
         self.labels = []
         self.entities = []
-        with open(path, "r", encoding="utf-8") as file:
-            data = file.readlines()
-            for example in data:
-                sentence, entity1, entity2, id, label = example.strip().split("\t")
-                self.sentences.append(sentence)
-                if eval(label) == 1:
-                    self.labels.append(1)
-                elif eval(label) == -1:
-                    self.labels.append(0)
-
-                self.entities.append([entity1, entity2])
+        for example in read_re_examples(path):
+            self.sentences.append(example.sentence)
+            if example.label == 1:
+                self.labels.append(1)
+            elif example.label == -1:
+                self.labels.append(0)
+
+            self.entities.append([example.entity1, example.entity2])
 
         logger.info("Number of Example in {}: {}".format(path, str(len(self.labels))))
         
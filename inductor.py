@@ -10,7 +10,13 @@ from transformers import (AutoModelForSeq2SeqLM, AutoTokenizer,
                           BartForConditionalGeneration, BartTokenizer)
 
 from dpp_sampler import DPPsampler
+from src.async_inductor import AsyncInductor
 from src.bart_with_group_beam import BartForConditionalGeneration_GroupBeam
+from src.graph_export import ExportedGroupBeam
+from src.model_registry import get_model, get_tokenizer, is_cuda
+from src.premise import ResultCache, canonicalize, copy_rules
+from src.seeding import seeded
+from src.tracing import NULL_TRACER
 from src.utils import (construct_template, filter_words,
                        formalize_tA, post_process_template, align, dict_add)
 
@@ -40,28 +46,68 @@ class BartInductor(object):
         continue_pretrain_hypo_generator=True,
         if_then=False,
         mcgs=True,
-        dpp=True
+        dpp=True,
+        rescore=False,
+        instance_streams=0,
+        top_p=0.9,
+        temperature=1.0,
+        n_clusters=0,
+        cluster_method='minibatch',
+        cluster_dim=None,
+        dedup_threshold=None,
+        result_cache_size=1024,
+        adaptive_decoding=False,
+        decode_budget=None,
+        share_prefix=False,
+        quantize=None,
+        export_dir=None,
+        tracer=None
     ):
         self.device = device
+        self.tracer = tracer if tracer is not None else NULL_TRACER
+        self.async_runner = None
         self.if_then = if_then
         self.mcgs = mcgs
         self.dpp = dpp
+        self.rescore = rescore
+        # instance_streams > 0 replaces beam-sample instance generation with instance_streams * k nucleus samples
+        self.instance_streams = instance_streams
+        self.top_p = top_p
+        self.temperature = temperature
+        # n_clusters > 0 clusters the instances and generates hypotheses per cluster, see DPPsampler.cluster
+        self.n_clusters = n_clusters
+        self.cluster_method = cluster_method
+        self.cluster_dim = cluster_dim
+        # dedup_threshold drops hypotheses whose embedding cosine to a better one reaches it, before DPP
+        self.dedup_threshold = dedup_threshold
+        # results of seeded requests, keyed by (premise hash, k, topk, seed, with_scores); unseeded requests are random by design
+        self.result_cache = ResultCache(result_cache_size)
+        # adaptive_decoding retires a beam group of the hypothesis generator once it has produced its hypothesis;
+        # decode_budget caps instances * beams per premise, see hypothesis_beams
+        self.adaptive_decoding = adaptive_decoding
+        self.decode_budget = decode_budget
+        # share_prefix runs beams of a template that share their decoder prefix through the decoder once per step
+        self.share_prefix = share_prefix
+        # int8 dynamic quantization of the generators and the DPP encoder on CPU; None defers to the model registry
+        self.quantize = quantize
+        # export_dir runs the hypothesis generator's group beam search on the CPU graphs of src/graph_export.py
+        # (quantized or not as exported) instead of the PyTorch model
+        if export_dir is not None and (not group_beam or is_cuda(device)):
+            raise ValueError('export_dir needs group_beam=True on a CPU device')
+        self.export_dir = export_dir
+        self.group_beam = group_beam
         self.orion_instance_generator_path = 'facebook/bart-large' if not continue_pretrain_instance_generator else ORION_INS_GENERATOR
         self.orion_hypothesis_generator_path = 'facebook/bart-large' if not continue_pretrain_hypo_generator else ORION_HYPO_GENERATOR
 
-        if group_beam:
-            self.orion_hypothesis_generator = BartForConditionalGeneration_GroupBeam.from_pretrained(self.orion_hypothesis_generator_path).cuda(self.device).eval().half()
-            self.orion_instance_generator = BartForConditionalGeneration.from_pretrained(self.orion_instance_generator_path).cuda(self.device).eval().half()   
-            #self.bs_generator = BartForConditionalGeneration.from_pretrained(self.orion_hypothesis_generator_path).cuda(self.device).eval()
-        else:
-            self.orion_hypothesis_generator = BartForConditionalGeneration.from_pretrained(self.orion_hypothesis_generator_path).cuda(self.device).eval()#.half()
-            self.orion_instance_generator = BartForConditionalGeneration.from_pretrained(self.orion_instance_generator_path).cuda(self.device).eval()#.half()
-            #self.bs_generator = BartForConditionalGeneration.from_pretrained(self.orion_hypothesis_generator_path).cuda(self.device).eval()#.half()
+        # generators are loaded on first use through the process-wide model registry, see warmup()
+        self._orion_hypothesis_generator = None
+        self._orion_instance_generator = None
+        #self.bs_generator = BartForConditionalGeneration.from_pretrained(self.orion_hypothesis_generator_path).to(self.device).eval()
     
-        self.tokenizer = BartTokenizer.from_pretrained("facebook/bart-large")
+        self.tokenizer = get_tokenizer(BartTokenizer, "facebook/bart-large")
         self.word_length = 2
 
-        self.dpp_sampler = DPPsampler(device)
+        self.dpp_sampler = DPPsampler(device, tracer=self.tracer, quantize=quantize)
 
         self.stop_sub_list = ['he', 'she', 'this', 'that', 'and', 'it', 'which', 'who', 'whose', 'there', 'they', '.', 'its', 'one',
                                 'i', ',', 'the', 'nobody', 'his', 'her', 'also', 'only', 'currently', 'here', '()', 'what', 'where',
@@ -81,10 +127,38 @@ class BartInductor(object):
 
         self.bad_words_ids = [self.tokenizer.encode(bad_word)[1:-1] for bad_word in ['also', ' also']]
         stop_index = self.tokenizer(self.stop_sub_list, max_length=4, padding=True)
-        stop_index = torch.tensor(stop_index['input_ids'])[:, 1]
-        stop_weight = torch.zeros(1, self.tokenizer.vocab_size).cuda(self.device)
-        stop_weight[0, stop_index] -= 100
-        self.stop_weight = stop_weight[0, :]
+        # first sub-token of every stop word; explore_mask pushes these 100 below any real probability
+        self.stop_index = torch.unique(torch.tensor(stop_index['input_ids'])[:, 1]).to(self.device)
+        self._token_strs = None
+        self._token_valid = None
+
+    @property
+    def orion_hypothesis_generator(self):
+        if self._orion_hypothesis_generator is None:
+            if self.export_dir is not None:
+                self._orion_hypothesis_generator = ExportedGroupBeam(self.export_dir)
+            elif self.group_beam:
+                self._orion_hypothesis_generator = get_model(BartForConditionalGeneration_GroupBeam, self.orion_hypothesis_generator_path, self.device, half=True, quantize=self.quantize)
+            else:
+                self._orion_hypothesis_generator = get_model(BartForConditionalGeneration, self.orion_hypothesis_generator_path, self.device, quantize=self.quantize)#.half()
+        return self._orion_hypothesis_generator
+
+    @property
+    def orion_instance_generator(self):
+        if self._orion_instance_generator is None:
+            self._orion_instance_generator = get_model(BartForConditionalGeneration, self.orion_instance_generator_path, self.device, half=self.group_beam, quantize=self.quantize)
+        return self._orion_instance_generator
+
+    def warmup(self, premise=None):
+        """Load every component the configured pipeline needs; optionally run one premise end to end."""
+        self.orion_instance_generator
+        self.orion_hypothesis_generator
+        if self.dpp:
+            self.dpp_sampler.model
+        if self.rescore:
+            self.dpp_sampler.rescorer
+        if premise is not None:
+            self.generate(premise)
 
     def clean(self, text):
         segments = text.split('<mask>')
@@ -93,55 +167,154 @@ class BartInductor(object):
         else:
             return text
 
-    def generate(self, inputs, k=10, topk=10):
-        with torch.no_grad():
-            #tB_probs = self.generate_rule(inputs, k)
-            tB_probs = self.generate_rule_improved(inputs, k)
-            #tB_probs = self.generate_rule_prompt(inputs, k)
-            ret = [t[0].replace('<ent0>','<mask>').replace('<ent1>','<mask>') for t in tB_probs]
-
-            new_ret = []
-            for temp in ret:
-                temp = self.clean(temp.strip())
-                if len(new_ret) < topk and temp not in new_ret:
-                    new_ret.append(temp)
-
-            return new_ret
-
-    def explore_mask(self, tA, k, tokens, prob, required_token, probs):
-        if required_token == 0:
-            return [[tokens, prob, probs]]
-        if required_token <= self.word_length:
-            k = min(k, 2)
-        ret = []
-        generated_ids = self.tokenizer(tA, max_length=128, padding='longest', return_tensors='pt')  # ["input_ids"].cuda(self.device)
-        for key in generated_ids.keys():
-            generated_ids[key] = generated_ids[key].cuda(self.device)
-        mask_index = torch.where(generated_ids["input_ids"][0] == self.tokenizer.mask_token_id)
-        generated_ret = self.orion_instance_generator(**generated_ids)
-        #logits = generated_ret.logits
-        logits = generated_ret[0]
-        softmax = F.softmax(logits, dim=-1)
-        mask_word = softmax[0, mask_index[0][0], :] + self.stop_weight
-        top_k = torch.topk(mask_word, k, dim=0)
-        for i in range(top_k[1].size(0)):
-            token_s = top_k[1][i]
-            prob_s = top_k[0][i].item()
-            token_this = self.tokenizer.decode([token_s]).strip()
-            if token_this[0].isalpha() == False or len(token_this) <= 2:
-                continue
-            index_s = tA.index(self.tokenizer.mask_token)
-            tAs = tA[:index_s] + token_this + tA[index_s + len(self.tokenizer.mask_token):]
-            tokens_this = [t for t in tokens]
-            tokens_this.append(token_this)
-            probs_new = deepcopy(probs)
-            probs_new.append(prob_s)
-            ret.extend(self.explore_mask(tAs, 1, tokens_this, prob_s * prob, required_token - 1,probs_new))
+    def cached_result(self, premise, k, topk, seed, with_scores=False):
+        if seed is None:
+            return None
+        ret = self.result_cache.get((premise.hash, k, topk, seed, with_scores))
+        if ret is not None:
+            self.tracer.count('result_cache.hits')
         return ret
 
+    def cache_result(self, premise, k, topk, seed, rules, with_scores=False):
+        if seed is not None:
+            self.result_cache.put((premise.hash, k, topk, seed, with_scores), rules)
+
+    def generate(self, inputs, k=10, topk=10, seed=None):
+        premise = canonicalize(inputs)
+        with torch.no_grad(), self.tracer.request(premise=inputs, k=k, topk=topk, seed=seed):
+            ret = self.cached_result(premise, k, topk, seed)
+            if ret is not None:
+                return ret
+            #tB_probs = self.generate_rule(premise.text, k)
+            tB_probs = self.generate_rule_improved(premise.text, k, seed=seed)
+            #tB_probs = self.generate_rule_prompt(premise.text, k)
+            with self.tracer.stage('post_process'):
+                ret = self.post_process(tB_probs, topk)
+            self.cache_result(premise, k, topk, seed, ret)
+            return ret
+
+    def generate_batch(self, inputs_list, k=10, topk=10, seed=None, with_scores=False):
+        # Instance generation is batched across premises. Hypothesis generation stays per premise because the
+        # group beam search averages scores over its whole batch, which must only contain one premise's instances.
+        with torch.no_grad(), self.tracer.request(premises=inputs_list, k=k, topk=topk, seed=seed):
+            premises = [canonicalize(inputs) for inputs in inputs_list]
+            results = {}
+            for premise in premises:
+                ret = self.cached_result(premise, k, topk, seed, with_scores)
+                if ret is not None:
+                    results[premise.hash] = ret
+            # equivalent premises (same hash) are generated once; the first spelling is the one the models see
+            todo = {}
+            for premise in premises:
+                if premise.hash not in results and premise.hash not in todo:
+                    todo[premise.hash] = premise
+            todo = list(todo.values())
+            if len(todo) == 0:
+                return [copy_rules(results[premise.hash]) for premise in premises]
+
+            with self.tracer.stage('generate_ins'):
+                if seed is None:
+                    words_probs = self.sample_instances([premise.text for premise in todo], k)
+                else:
+                    # one draw per premise, so a seeded result does not depend on what it was batched with
+                    words_probs = []
+                    for premise in todo:
+                        with seeded(seed, self.device):
+                            words_probs.extend(self.sample_instances([premise.text], k))
+
+            for premise, words_prob in zip(todo, words_probs):
+                tB_probs = self.induce_rules(premise.text, words_prob, k, seed=seed)
+                with self.tracer.stage('post_process'):
+                    results[premise.hash] = self.post_process(tB_probs, topk, with_scores)
+                self.cache_result(premise, k, topk, seed, results[premise.hash], with_scores)
+
+            return [copy_rules(results[premise.hash]) for premise in premises]
+
+    async def agenerate(self, inputs, k=10, topk=10, timeout=None, seed=None):
+        # every call is funnelled through one AsyncInductor, i.e. one model-execution loop per inductor
+        if self.async_runner is None:
+            self.async_runner = AsyncInductor(self)
+        return await self.async_runner.agenerate(inputs, k=k, topk=topk, timeout=timeout, seed=seed)
+
+    def post_process(self, tB_probs, topk=10, with_scores=False):
+        ret = [t[0].replace('<ent0>','<mask>').replace('<ent1>','<mask>') for t in tB_probs]
+
+        new_ret = []
+        scores = []
+        for temp, t in zip(ret, tB_probs):
+            temp = self.clean(temp.strip())
+            if len(new_ret) < topk and temp not in new_ret:
+                new_ret.append(temp)
+                if with_scores:
+                    # induce_rules yields [template, [full_text, score]], or [text, 0] when nothing was found
+                    scores.append(float(t[1][1] if isinstance(t[1], list) else t[1]))
+
+        if with_scores:
+            return [[temp, score] for temp, score in zip(new_ret, scores)]
+        return new_ret
+
+    def token_table(self):
+        """Stripped text of every vocabulary token, and whether explore_mask accepts it as a word piece."""
+        if self._token_strs is None:
+            self._token_strs = [t.strip() for t in self.tokenizer.batch_decode([[i] for i in range(len(self.tokenizer))])]
+            self._token_valid = [len(t) > 2 and t[0].isalpha() for t in self._token_strs]
+        return self._token_strs, self._token_valid
+
+    def mask_logits(self, generated_ids, mask_index):
+        """Instance-generator logits at one position per row, without projecting the other positions onto the vocabulary."""
+        model = self.orion_instance_generator
+        hidden = model.model(**generated_ids)[0]
+        hidden = hidden[torch.arange(hidden.size(0), device=hidden.device), mask_index]
+        return model.lm_head(hidden) + model.final_logits_bias[0]
+
+    def explore_mask(self, tA, k, tokens, prob, required_token, probs, beam_width=None, batch_size=64):
+        """Fill the masks of ``tA`` left to right, one token per step.
+
+        The first step branches into the top ``k`` tokens (at most 2 when only
+        one word is masked) and later steps extend every branch greedily. All
+        branches of a step are scored together in padded batches of
+        ``batch_size``, so the instance generator runs once per step and chunk
+        instead of once per branch and step. ``beam_width`` keeps only the most
+        probable branches after each step.
+        """
+        token_strs, token_valid = self.token_table()
+        frontier = [[tA, tokens, prob, probs]]
+        while required_token > 0 and len(frontier) > 0:
+            if required_token <= self.word_length:
+                k = min(k, 2)
+            expanded = []
+            for start in range(0, len(frontier), batch_size):
+                chunk = frontier[start:start + batch_size]
+                generated_ids = self.tokenizer([c[0] for c in chunk], max_length=128, padding='longest', return_tensors='pt')
+                for key in generated_ids.keys():
+                    generated_ids[key] = generated_ids[key].to(self.device)
+                # first remaining mask of every row
+                mask_index = (generated_ids["input_ids"] == self.tokenizer.mask_token_id).int().argmax(dim=1)
+                logits = self.mask_logits(generated_ids, mask_index)
+                self.tracer.count('model_calls.instance_generator')
+                mask_word = F.softmax(logits, dim=-1)
+                mask_word[:, self.stop_index] -= 100
+                top_k = torch.topk(mask_word, k, dim=1)
+                top_probs = top_k[0].tolist()
+                top_tokens = top_k[1].tolist()
+                for (tA_c, tokens_c, prob_c, probs_c), prob_row, token_row in zip(chunk, top_probs, top_tokens):
+                    for prob_s, token_s in zip(prob_row, token_row):
+                        if not token_valid[token_s]:
+                            continue
+                        token_this = token_strs[token_s]
+                        index_s = tA_c.index(self.tokenizer.mask_token)
+                        tAs = tA_c[:index_s] + token_this + tA_c[index_s + len(self.tokenizer.mask_token):]
+                        expanded.append([tAs, tokens_c + [token_this], prob_s * prob_c, probs_c + [prob_s]])
+            if beam_width is not None:
+                expanded = sorted(expanded, key=lambda x: x[2], reverse=True)[:beam_width]
+            frontier = expanded
+            required_token -= 1
+            k = 1
+        return [[tokens_c, prob_c, probs_c] for _, tokens_c, prob_c, probs_c in frontier]
+
     def extract_words_for_tA_bart(self, tA, k=6, softmax=True):
         spans = [t.lower().strip() for t in tA[:-1].split('<mask>')]
-        generated_ids = self.tokenizer([tA], padding='longest', return_tensors='pt')['input_ids'].cuda(self.device)
+        generated_ids = self.tokenizer([tA], padding='longest', return_tensors='pt')['input_ids'].to(self.device)
         generated_ret = self.orion_instance_generator.generate(generated_ids, num_beams=k,#max(120, k),
                                             #num_beam_groups=max(120, k),
                                             max_length=generated_ids.size(1) + 15,
@@ -205,8 +378,7 @@ class BartInductor(object):
         return sorted(ret, key=lambda x: x[1], reverse=True)[:k]
 
     def generate_ins(self, tA, k=6, softmax=True):
-        spans = [t.lower().strip() for t in tA[:-1].split('<mask>')]
-        generated_ids = self.tokenizer([tA], padding='longest', return_tensors='pt')['input_ids'].cuda(self.device)
+        generated_ids = self.tokenizer([tA], padding='longest', return_tensors='pt')['input_ids'].to(self.device)
         generated_ret = self.orion_instance_generator.generate(generated_ids, num_beams=k,#max(120, k),
                                             #num_beam_groups=max(120, k),
                                             max_length=generated_ids.size(1) + 15,
@@ -218,11 +390,92 @@ class BartInductor(object):
                                             do_sample=True, # MC instand of beam search
                                             return_dict_in_generate=True)
         summary_ids = generated_ret['sequences']
+        self.tracer.count('model_calls.instance_generator')
+        self.tracer.count('sequences.instances', summary_ids.size(0))
         if softmax:
             probs = F.softmax(generated_ret['sequences_scores'])
         else:
             probs = generated_ret['sequences_scores']
         txts = [self.tokenizer.decode(g, skip_special_tokens=True, clean_up_tokenization_spaces=True) for g in summary_ids]
+        return self.align_instances(tA, txts, probs, k)
+
+    def sample_instances(self, tAs, k=6):
+        if self.instance_streams > 0:
+            return self.sample_ins_batch(tAs, k, self.instance_streams, self.top_p, self.temperature)
+        return self.generate_ins_batch(tAs, k, softmax=True)
+
+    def generate_ins_batch(self, tAs, k=6, softmax=True):
+        generated = self.tokenizer(tAs, padding='longest', return_tensors='pt')
+        generated_ids = generated['input_ids'].to(self.device)
+        generated_ret = self.orion_instance_generator.generate(generated_ids, num_beams=k,
+                                            attention_mask=generated['attention_mask'].to(self.device),
+                                            max_length=generated_ids.size(1) + 15,
+                                            num_return_sequences=k,
+                                            output_scores=True,
+                                            do_sample=True, # MC instand of beam search
+                                            return_dict_in_generate=True)
+        summary_ids = generated_ret['sequences'].reshape((len(tAs), k, -1))
+        self.tracer.count('model_calls.instance_generator')
+        self.tracer.count('sequences.instances', len(tAs) * k)
+        scores = generated_ret['sequences_scores'].reshape((len(tAs), k))
+        probs = F.softmax(scores, dim=1) if softmax else scores
+        ret = []
+        for i, tA in enumerate(tAs):
+            txts = [self.tokenizer.decode(g, skip_special_tokens=True, clean_up_tokenization_spaces=True) for g in summary_ids[i]]
+            ret.append(self.align_instances(tA, txts, probs[i], k))
+        return ret
+
+    def sample_ins_batch(self, tAs, k=6, streams=10, top_p=0.9, temperature=1.0, softmax=True):
+        """Draw ``streams * k`` independent nucleus samples per premise in one generate call.
+
+        Each sample is scored by its mean token log-probability under the
+        sampling distribution (after top-p and temperature), duplicates are
+        merged keeping the best score, and every distinct aligned instance is
+        returned, best first.
+        """
+        num_samples = streams * k
+        generated = self.tokenizer(tAs, padding='longest', return_tensors='pt')
+        generated_ids = generated['input_ids'].to(self.device)
+        generated_ret = self.orion_instance_generator.generate(generated_ids, num_beams=1,
+                                            attention_mask=generated['attention_mask'].to(self.device),
+                                            max_length=generated_ids.size(1) + 15,
+                                            num_return_sequences=num_samples,
+                                            do_sample=True,
+                                            top_k=0,
+                                            top_p=top_p,
+                                            temperature=temperature,
+                                            output_scores=True,
+                                            return_dict_in_generate=True)
+        sequences = generated_ret['sequences']
+        self.tracer.count('model_calls.instance_generator')
+        self.tracer.count('sequences.instances', sequences.size(0))
+
+        # sequences start with the decoder start token; scores[t] is the warped distribution of sequences[:, t + 1]
+        tokens = sequences[:, 1:]
+        logprobs = torch.stack([F.log_softmax(score.float(), dim=-1).gather(1, tokens[:, t:t + 1])[:, 0]
+                                for t, score in enumerate(generated_ret['scores'])], dim=1)
+        # count every token up to and including the first eos
+        finished = (tokens == self.tokenizer.eos_token_id).long().cumsum(dim=1)
+        valid = (finished == 0) | ((finished == 1) & (tokens == self.tokenizer.eos_token_id))
+        # padding after eos may be outside the nucleus, i.e. -inf, so mask instead of multiplying
+        seq_scores = logprobs.masked_fill(~valid, 0).sum(dim=1) / valid.sum(dim=1).clamp(min=1)
+        seq_scores = seq_scores.reshape(len(tAs), num_samples)
+
+        sequences = sequences.reshape(len(tAs), num_samples, -1)
+        ret = []
+        for i, tA in enumerate(tAs):
+            best = {}
+            txts = self.tokenizer.batch_decode(sequences[i], skip_special_tokens=True, clean_up_tokenization_spaces=True)
+            for txt, score in zip(txts, seq_scores[i].tolist()):
+                if txt not in best or score > best[txt]:
+                    best[txt] = score
+            self.tracer.count('sequences.unique_instances', len(best))
+            scores = torch.tensor(list(best.values()))
+            probs = F.softmax(scores, dim=0) if softmax else scores
+            ret.append(self.align_instances(tA, list(best.keys()), probs, len(best)))
+        return ret
+
+    def align_instances(self, tA, txts, probs, k):
         ret = []
 
         for i, txt in enumerate(txts):
@@ -241,11 +494,11 @@ class BartInductor(object):
 
         return sorted(ret, key=lambda x: x[1], reverse=True)[:k]
 
-    def extract_words_for_tA(self, tA, k=6):
+    def extract_words_for_tA(self, tA, k=6, beam_width=None):
         word_mask_str = ' '.join([self.tokenizer.mask_token] * self.word_length)
         tA = tA.replace('<mask>', word_mask_str)
         mask_count = tA.count(self.tokenizer.mask_token)
-        mask_probs = self.explore_mask(tA, k*20, [], 1.0, mask_count, [])
+        mask_probs = self.explore_mask(tA, k*20, [], 1.0, mask_count, [], beam_width=beam_width)
         ret = []
         visited_mask_txt = {}
         for mask, prob, probs in mask_probs:
@@ -283,7 +536,7 @@ class BartInductor(object):
                 index_words[len(index_words)] = '\t'.join(words)
             # index_words[len(templates)-1] = '\t'.join(words)
             if (len(templates) == batch_size) or enum==len(words_prob_sorted)-1 or (words_prob_sorted[enum+1][2]!=words_prob_sorted[enum][2]):
-                generated_ids = self.tokenizer(templates, padding="longest", return_tensors='pt')['input_ids'].cuda(self.device)
+                generated_ids = self.tokenizer(templates, padding="longest", return_tensors='pt')['input_ids'].to(self.device)
                 generated_ret = self.orion_hypothesis_generator.generate(generated_ids, num_beams=num_beams,
                                                     num_beam_groups=num_beams,
                                                     max_length=28, #template_length+5,
@@ -367,47 +620,66 @@ class BartInductor(object):
                 ret[i][0] = sentence
         return ret
 
-    def generate_rule_improved(self, tA, k=10):
-        tA = formalize_tA(tA)
-        tA = tA.replace('<mask>', ' <mask> ').replace('  ', ' ')
+    def prepare_premise(self, tA):
+        return canonicalize(tA).text
+
+    def generate_rule_improved(self, tA, k=10, seed=None):
+        tA = self.prepare_premise(tA)
          
-        words_prob = self.generate_ins(tA, k, softmax=True)#self.extract_words_for_tA_bart(tA, k*10, softmax=True) 
-        words_prob = filter_words(words_prob)#[:k]
+        with self.tracer.stage('generate_ins'), seeded(seed, self.device):
+            if self.instance_streams > 0:
+                words_prob = self.sample_ins_batch([tA], k, self.instance_streams, self.top_p, self.temperature)[0]
+            else:
+                words_prob = self.generate_ins(tA, k, softmax=True)#self.extract_words_for_tA_bart(tA, k*10, softmax=True) 
+        return self.induce_rules(tA, words_prob, k, seed=seed)
+
+    def induce_rules(self, tA, words_prob, k=10, seed=None):
+        with self.tracer.stage('filter_words'):
+            words_prob = filter_words(words_prob)#[:k]
 
         sents = [[tA.replace('<mask>', word[0][0], 1).replace('<mask>', word[0][1], 1), word[1]] for word in words_prob]
 
-        # -clusting
-        rhs_scores = self.extract_templateBs_batch_global_score(words_prob, tA, k, softmax=True)
+        if self.n_clusters > 0:
+            # clusting ins (SOTA:K5)
+            labels = self.dpp_sampler.cluster(sents, self.n_clusters, self.cluster_method, self.cluster_dim, random_state=seed)
+            clusters = {}
+            for word, label in zip(words_prob, labels):
+                clusters.setdefault(label, []).append(word)
+
+            rhs_scores = {}
+            with self.tracer.stage('extract_templateBs_batch_global_score'):
+                for label in sorted(clusters.keys()):
+                    # the decode budget is per premise, so every cluster is sized against all instances
+                    new_rhs = self.extract_templateBs_batch_global_score(clusters[label], tA, k, softmax=True,
+                                                                         num_instances=len(words_prob))
+                    rhs_scores = dict_add(rhs_scores, new_rhs)
+                    #rhs_scores.update(self.generate_rhs_cluster_group_beam(cluster, tA, k, softmax=True))
+        else:
+            # -clusting
+            with self.tracer.stage('extract_templateBs_batch_global_score'):
+                rhs_scores = self.extract_templateBs_batch_global_score(words_prob, tA, k, softmax=True)
         #rhs_scores_abs = self.extract_templateBs_batch_global_score_beam_search(words_prob, tA, k, softmax=True)
         #rhs_scores = dict_add(rhs_scores_abs, rhs_scores_agb)
 
-        '''
-        # clusting ins (SOTA:K5)
-        
-        n_clusters = 5
-        clusters = []
-        rhs_scores = {}
-        labels = self.dpp_sampler.Kmeans_clusting(sents, n_clusters) if len(sents) > n_clusters else list(range(len(sents)))
-        for n in range(n_clusters):
-            clusters.append([words_prob[i] for i in range(len(sents)) if labels[i] == n])
-        
-        #rhs_scores = {}
-        for cluster in clusters:
-            if len(cluster) > 0:
-                new_rhs = self.extract_templateBs_batch_global_score(cluster, tA, k, softmax=True)
-                rhs_scores = dict_add(rhs_scores, new_rhs)
-                #rhs_scores.update(self.generate_rhs_cluster_group_beam(cluster, tA, k, softmax=True))
-        '''
-
         #rhs_ls = [[key, rhs_scores[key]] for key in rhs_scores.keys() if rhs_scores[key] > 0]
         #rhs_text = [[t[0].replace('<ent0>', 'A').replace('<ent1>', 'B'), t[1]] for t in rhs_ls]
         # full-text
         rhs_ls = [[key, rhs_scores[key]] for key in rhs_scores.keys() if rhs_scores[key][1] > 0]
         rhs_text = [rhs_scores[key] for key in rhs_scores.keys() if rhs_scores[key][1] > 0]
         
-        # rescoring!
-        #rhs_res = self.dpp_sampler.rescoring(rhs_text)
-        #rhs_text = [[r[0], r[1]*r[2]] for r in rhs_res]
+        # near-duplicates are dropped first, so neither GPT-2 rescoring nor DPP spends compute on them
+        if self.dedup_threshold is not None and len(rhs_text) > 1:
+            with self.tracer.stage('DPPsampler.dedup'):
+                keep = self.dpp_sampler.dedup(rhs_text, self.dedup_threshold)
+            rhs_ls = [rhs_ls[i] for i in keep]
+            rhs_text = [rhs_text[i] for i in keep]
+
+        # rescoring! (rhs_ls and rhs_text share the [full_text, score] lists, so both see the new scores)
+        if self.rescore and len(rhs_text) > 0:
+            with self.tracer.stage('DPPsampler.rescoring'):
+                rescores = self.dpp_sampler.rescoring(rhs_text)
+            for r, rescore in zip(rhs_text, rescores):
+                r[1] *= rescore
         
         # softmax
         #scores = [r[1] for r in rhs_text]
@@ -417,9 +689,12 @@ class BartInductor(object):
         #ret = rhs_ls
         
         # DPP
-        if len(rhs_text) > 0:
-            selected_ids = self.dpp_sampler.dpp(rhs_text, k)
+        if len(rhs_text) > 0 and self.dpp:
+            with self.tracer.stage('DPPsampler.dpp'):
+                selected_ids = self.dpp_sampler.dpp(rhs_text, k)
             ret = [rhs_ls[id] for id in selected_ids]
+        elif len(rhs_text) > 0:
+            ret = rhs_ls
         else:
             ret = [['no proper relation hypothesis', 0]]
         
@@ -436,8 +711,7 @@ class BartInductor(object):
         return ret
 
     def generate_rule_prompt(self, tA, k=10):
-        tA = formalize_tA(tA)
-        tA = tA.replace('<mask>', ' <mask> ').replace('  ', ' ').strip()
+        tA = self.prepare_premise(tA).strip()
 
         with open('./data/prompt_type_20.txt') as f:
             lines = f.readlines()
@@ -492,9 +766,11 @@ class BartInductor(object):
         #rhs_res = self.dpp_sampler.rescoring(rhs_text)
         #rhs_text = [[r[0], r[1]*r[2]] for r in rhs_res]
     
-        if len(rhs_text) > 0:
+        if len(rhs_text) > 0 and self.dpp:
             selected_ids = self.dpp_sampler.dpp(rhs_text, k)
             ret = [rhs_ls[id] for id in selected_ids]
+        elif len(rhs_text) > 0:
+            ret = rhs_ls
         else:
             ret = [['no proper relation hypothesis', 0]]
 
@@ -525,7 +801,7 @@ class BartInductor(object):
         ins, score = scored_ins
         template = construct_template(ins, tA, self.if_then)
         num_beams = k
-        generated_ids = self.tokenizer(template, padding="longest", return_tensors='pt')['input_ids'].cuda(self.device)
+        generated_ids = self.tokenizer(template, padding="longest", return_tensors='pt')['input_ids'].to(self.device)
         generated_ret = self.orion_hypothesis_generator.generate(generated_ids, num_beams=num_beams,
                                             num_beam_groups=num_beams,
                                             max_length=28, #template_length+5,
@@ -559,7 +835,70 @@ class BartInductor(object):
             ret.update({txt:np.exp(score_rh)})
         return ret
 
-    def extract_templateBs_batch_global_score(self, words_prob, tA, k, softmax=False):
+    def hypothesis_beams(self, k, num_instances):
+        """Beams (= beam groups) per instance template under ``decode_budget``.
+
+        ``k``, lowered so that ``num_instances * beams`` stays within the
+        budget, ``num_instances`` being all instances of the premise. Premises
+        with many instances already get many candidates from the instances
+        alone.
+        """
+        if self.decode_budget is None or num_instances == 0:
+            return k
+        # group beam search needs at least two groups
+        return max(2, min(k, self.decode_budget // num_instances))
+
+    def aggregate_hypotheses(self, sequences, probs, weights, words_list, ret):
+        """Add one generate call's hypotheses to ``ret`` (template -> [full text, summed score]).
+
+        Row n of ``sequences`` is a beam of template n // num_beams, whose instance words are
+        ``words_list[n // num_beams]`` and weight ``weights[n // num_beams]``. The validity checks
+        run on the decoded strings. Sequences and scores reach the host in a single transfer per call.
+        """
+        num_beams = probs.size(1)
+        # float64 so every score is exactly float(prob) * probA, as when multiplied on the host;
+        # token ids are exact in float64 too, so both travel in one tensor
+        weights = torch.tensor(weights, dtype=torch.float64, device=probs.device)
+        scores = (probs.double() * weights[:, None]).reshape(-1, 1)
+        host = torch.cat([sequences.double(), scores], dim=1).cpu()
+        sequences, scores = host[:, :-1].long(), host[:, -1].tolist()
+        txts = self.tokenizer.batch_decode(sequences.tolist(), skip_special_tokens=True, clean_up_tokenization_spaces=True)
+        candidates = []
+        valid = []
+        for n, txt in enumerate(txts):
+            # save full text
+            full_txt = post_process_template(txt.lower())
+            txt = full_txt
+            is_valid = True
+            for j, word in enumerate(words_list[n // num_beams]):
+                word = word.lower()
+                if word not in txt:
+                    is_valid = False
+                else:
+                    txt = txt.replace(word, '<ent{}>'.format(j), 1)
+            if not txt.endswith('<ent1>.'):
+                is_valid = False
+            valid.append(is_valid)
+
+            if txt.count(' ')+1<=3:
+                self.tracer.count('candidates.too_short')
+                candidates.append(None)
+            else:
+                candidates.append((txt, full_txt))
+
+        for candidate, prob, is_valid in zip(candidates, scores, valid):
+            if candidate is None:
+                continue
+            if not is_valid:
+                prob = 0.0
+            if prob == 0.0:
+                self.tracer.count('candidates.filtered')
+            template, full_text = candidate
+            if template not in ret:
+                ret[template] = [full_text, 0.0]
+            ret[template][1] += prob
+
+    def extract_templateBs_batch_global_score(self, words_prob, tA, k, softmax=False, num_instances=None):
         words_prob_sorted = []
         for (words, probA, *_) in words_prob:
             tokenized_word = self.tokenizer(words[0])
@@ -568,105 +907,64 @@ class BartInductor(object):
 
         batch_size = 8
         templates = []
-        index_words = {}
+        batch_words = []
+        batch_scores = []
         ret = {}
-        num_beams = k
-        scores = []
+        # num_instances: the premise's instance count when words_prob is only one cluster of it
+        num_beams = self.hypothesis_beams(k, len(words_prob) if num_instances is None else num_instances)
         for enum, (words, probA, *_) in enumerate(words_prob_sorted):
             template = construct_template(words, tA, self.if_then)
             templates.extend(template)
-            scores.append(probA)
-            #model_kwargs = {'weights':torch.tensor(scores).cuda(self.device)}
-            weights = torch.tensor(scores).cuda(self.device)
             for t in template:
-                index_words[len(index_words)] = '\t'.join(words)
-            # index_words[len(templates)-1] = '\t'.join(words)
+                batch_words.append(words)
+                batch_scores.append(probA)
             if (len(templates) == batch_size) or enum==len(words_prob_sorted)-1 or (words_prob_sorted[enum+1][2]!=words_prob_sorted[enum][2]):
-                generated_ids = self.tokenizer(templates, padding="longest", return_tensors='pt')['input_ids'].cuda(self.device)
-                generated_ret = self.orion_hypothesis_generator.generate(generated_ids, num_beams=num_beams,
-                                                    num_beam_groups=num_beams,
-                                                    max_length=28, #template_length+5,
-                                                    num_return_sequences=num_beams, min_length=3,
-                                                    diversity_penalty=1.0,
-                                                    early_stopping=True,
-                                                    #length_penalty = 0.1,
-                                                    bad_words_ids=self.bad_words_ids,
-                                                    #no_repeat_ngram_size=2,
-                                                    output_scores=True,
-                                                    return_dict_in_generate=True, decoder_ori_input_ids = generated_ids,
-                                                    top_p=0.95,
-                                                    #**model_kwargs
-                                                    )
-                summary_ids = generated_ret['sequences'].reshape((len(templates),num_beams,-1))
+                generated_ids = self.tokenizer(templates, padding="longest", return_tensors='pt')['input_ids'].to(self.device)
+                with self.tracer.stage('group_beam_search'):
+                    generated_ret = self.orion_hypothesis_generator.generate(generated_ids, num_beams=num_beams,
+                                                        num_beam_groups=num_beams,
+                                                        max_length=28, #template_length+5,
+                                                        num_return_sequences=num_beams, min_length=3,
+                                                        diversity_penalty=1.0,
+                                                        early_stopping=True,
+                                                        #length_penalty = 0.1,
+                                                        bad_words_ids=self.bad_words_ids,
+                                                        #no_repeat_ngram_size=2,
+                                                        output_scores=True,
+                                                        return_dict_in_generate=True, decoder_ori_input_ids = generated_ids,
+                                                        decoder_adaptive=self.adaptive_decoding,
+                                                        decoder_share_prefix=self.share_prefix,
+                                                        top_p=0.95,
+                                                        )
+                self.tracer.count('model_calls.hypothesis_generator')
+                self.tracer.count('sequences.hypotheses', len(templates) * num_beams)
                 if softmax:
                     probs = F.softmax(generated_ret['sequences_scores'].reshape((len(templates),num_beams)),dim=1)
                 else:
                     probs = generated_ret['sequences_scores'].reshape((len(templates),num_beams))
-                for ii in range(summary_ids.size(0)):
-                    txts = [self.tokenizer.decode(g, skip_special_tokens=True, clean_up_tokenization_spaces=True) for g in summary_ids[ii]]
-                    ii_template = []
-                    words_ii = index_words[ii].split('\t')
-                    for i, txt in enumerate(txts):
-                        prob = probs[ii][i].item() * scores[ii] # * probA
-
-                        txt = txt.lower()
-                        
-                        # save full text
-                        full_txt = post_process_template(txt)
-                        
-                        txt = deepcopy(full_txt)
-                        
-                        # rescoring
-                        #rescore = self.dpp_sampler.rescoring([[txt, prob]])
-                        #prob = rescore[0] * scores[ii]
-
-                        words_ii_matched = [word.lower() for word in words_ii] #extract_similar_words(txt, words_ii)
-                        if words_ii_matched is None:
-                            prob = 0.0
-                        else:
-                            for j, word in enumerate(words_ii_matched):
-                                if word not in txt:
-                                    prob = 0.0
-                                else:
-                                    txt = txt.replace(word, '<ent{}>'.format(j), 1)
-                        
-                        if not txt.endswith('<ent1>.'):
-                            prob = 0.0
-
-                        if txt.count(' ')+1<=3:
-                            continue
-
-                        ii_template.append([txt, prob, full_txt])
-                    # if print_it:
-                        # print(index_words[ii]+'\t'+str(convert_for_print(ii_template)))
-
-                    
-                    for template, prob, full_text in ii_template:
-                        if template not in ret:
-                            ret[template] = [full_text, 0.0]
-                        ret[template][1] += prob
-                    
+                self.aggregate_hypotheses(generated_ret['sequences'], probs, batch_scores, batch_words, ret)
 
                 templates.clear()
-                index_words.clear()
+                batch_words.clear()
+                batch_scores.clear()
 
         return ret #sorted(ret, key=lambda x: ret[x], reverse=True)
 
-    def extract_templateBs_cluster_global_score(self, words_prob, tA, k, softmax=False):
+    def extract_templateBs_cluster_global_score(self, words_prob, tA, k, softmax=False, num_instances=None):
         templates = []
         scores = []
-        index_words = {}
+        words_list = []
         ret = {}
-        num_beams = k
+        # num_instances: the premise's instance count when words_prob is only one cluster of it
+        num_beams = self.hypothesis_beams(k, len(words_prob) if num_instances is None else num_instances)
         for enum, (words, probA, *_) in enumerate(words_prob):
             template = construct_template(words, tA, self.if_then)
             templates.extend(template)
-            scores.append(probA)
             for t in template:
-                index_words[len(index_words)] = '\t'.join(words)
-            # index_words[len(templates)-1] = '\t'.join(words)
+                words_list.append(words)
+                scores.append(probA)
 
-        generated_ids = self.tokenizer(templates, padding="longest", return_tensors='pt')['input_ids'].cuda(self.device)
+        generated_ids = self.tokenizer(templates, padding="longest", return_tensors='pt')['input_ids'].to(self.device)
         generated_ret = self.orion_hypothesis_generator.generate(generated_ids, num_beams=num_beams,
                                             num_beam_groups=num_beams,
                                             max_length=28, #template_length+5,
@@ -678,48 +976,15 @@ class BartInductor(object):
                                             #no_repeat_ngram_size=2,
                                             output_scores=True,
                                             return_dict_in_generate=True, decoder_ori_input_ids = generated_ids,
+                                            decoder_adaptive=self.adaptive_decoding,
+                                            decoder_share_prefix=self.share_prefix,
                                             top_p=0.95,
                                             )
-        summary_ids = generated_ret['sequences'].reshape((len(templates),num_beams,-1))
         if softmax:
             probs = F.softmax(generated_ret['sequences_scores'].reshape((len(templates),num_beams)),dim=1)
         else:
             probs = generated_ret['sequences_scores'].reshape((len(templates),num_beams))
-        for ii in range(summary_ids.size(0)):
-            txts = [self.tokenizer.decode(g, skip_special_tokens=True, clean_up_tokenization_spaces=True) for g in summary_ids[ii]]
-            ii_template = []
-            words_ii = index_words[ii].split('\t')
-            for i, txt in enumerate(txts):
-                prob = probs[ii][i].item() * scores[ii]
-
-                txt = txt.lower()
-                full_txt = post_process_template(txt)
-                        
-                txt = deepcopy(full_txt)
-
-                words_ii_matched = [word.lower() for word in words_ii] #extract_similar_words(txt, words_ii)
-                if words_ii_matched is None:
-                    prob = 0.0
-                else:
-                    for j, word in enumerate(words_ii_matched):
-                        if word not in txt:
-                            prob = 0.0
-                        else:
-                            txt = txt.replace(word, '<ent{}>'.format(j), 1)
-                
-                if not txt.endswith('<ent1>.'):
-                    prob = 0.0
-
-                if txt.count(' ')+1<=3:
-                    continue
-
-                ii_template.append([txt, prob, full_txt])
-            # if print_it:
-                # print(index_words[ii]+'\t'+str(convert_for_print(ii_template)))
-            for template, prob, full_txt in ii_template:
-                if template not in ret:
-                    ret[template] = [full_txt, 0.0]
-                ret[template][1] += prob
+        self.aggregate_hypotheses(generated_ret['sequences'], probs, scores, words_list, ret)
 
         return ret #sorted(ret, key=lambda x: ret[x], reverse=True)
 '''
@@ -744,7 +1009,7 @@ class BartInductor(object):
                 index_words[len(index_words)] = '\t'.join(words)
             # index_words[len(templates)-1] = '\t'.join(words)
             if (len(templates) == batch_size) or enum==len(words_prob_sorted)-1 or (words_prob_sorted[enum+1][2]!=words_prob_sorted[enum][2]):
-                generated_ids = self.tokenizer(templates, padding="longest", return_tensors='pt')['input_ids'].cuda(self.device)
+                generated_ids = self.tokenizer(templates, padding="longest", return_tensors='pt')['input_ids'].to(self.device)
                 generated_ret = self.bs_generator.generate(generated_ids, num_beams=num_beams,
                                                     num_beam_groups=num_beams,
                                                     max_length=28, #template_length+5,
@@ -0,0 +1,117 @@
+import argparse
+import glob
+import gzip
+import json
+import logging
+import os
+import re
+import time
+
+from inductor import BartInductor
+from src.data_reader import read_kb_rules, set_cache_dir
+from src.premise import canonicalize
+
+logger = logging.getLogger(__name__)
+
+KB_FILES = sorted(glob.glob('data/KB/*.txt'))
+
+
+def relation_phrase(relation):
+    # isCitizenOf -> is citizen of, hasAcademicAdvisor -> has academic advisor
+    return ' '.join(re.findall(r'[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+', relation)).lower()
+
+
+def relation_premise(relation):
+    return '<mask> {} <mask>.'.format(relation_phrase(relation))
+
+
+def load_premises(files):
+    """One entry per distinct body relation, listing every KB rule that uses it as body."""
+    premises = {}
+    for path in files:
+        for rule in read_kb_rules(path):
+            premise = canonicalize(relation_premise(rule.body))
+            if premise.hash not in premises:
+                premises[premise.hash] = {'hash': premise.hash, 'premise': premise.text.strip(), 'relation': rule.body, 'kb_rules': []}
+            premises[premise.hash]['kb_rules'].append({
+                'file': os.path.basename(path),
+                'rule': rule.rule,
+                'head': rule.head,
+                'head_premise': relation_premise(rule.head),
+                'inverted': rule.inverted,
+                'stats': rule.stats,
+            })
+    return list(premises.values())
+
+
+def load_done(path):
+    """Hashes already written to ``path``; a truncated tail (interrupted run) is cut off so appending stays valid."""
+    done = []
+    valid = True
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                done.append(json.loads(line))
+        except (EOFError, OSError, ValueError):
+            valid = False
+    if not valid:
+        logger.warning("{} ends in a partial write, keeping its first {} records".format(path, len(done)))
+        tmp = path + '.tmp'
+        with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+            for record in done:
+                f.write(json.dumps(record) + '\n')
+        os.replace(tmp, path)
+    return set(record['hash'] for record in done)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default='0')
+    parser.add_argument("--files", type=str, nargs='+', default=KB_FILES, help="AMIE or RuLES rule files")
+    parser.add_argument("--output", type=str, default='mined_rules.jsonl.gz')
+    parser.add_argument("--resume", action='store_true', help="skip premises already in --output and append to it")
+    parser.add_argument("--batch_size", type=int, default=16, help="premises per generate_batch call")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--topk", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--instance_streams", type=int, default=0, help="sample instance_streams * k instances instead of beam sampling")
+    parser.add_argument("--data_cache", type=str, default=None, help="directory for parsed copies of the data files, see src/data_reader.py")
+    args = parser.parse_args()
+    if args.data_cache is not None:
+        set_cache_dir(args.data_cache)
+
+    logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+        datefmt='%m/%d/%Y %H:%M:%S',
+        level=logging.INFO)
+
+    premises = load_premises(args.files)
+    done = load_done(args.output) if args.resume and os.path.exists(args.output) else set()
+    todo = [p for p in premises if p['hash'] not in done]
+    logger.info("{} distinct body relations, {} already mined, {} to go".format(len(premises), len(premises) - len(todo), len(todo)))
+
+    device = args.device if args.device == 'cpu' else 'cuda:' + args.device
+    inductor = BartInductor(device=device, instance_streams=args.instance_streams)
+
+    start = time.time()
+    num_premises = num_rules = 0
+    # every batch is its own gzip member, so an interrupted run loses at most the batch being written
+    mode = 'at' if args.resume else 'wt'
+    for b in range(0, len(todo), args.batch_size):
+        batch = todo[b:b + args.batch_size]
+        results = inductor.generate_batch([p['premise'] for p in batch], k=args.k, topk=args.topk, seed=args.seed, with_scores=True)
+        with gzip.open(args.output, mode, encoding='utf-8') as f:
+            for p, rules in zip(batch, results):
+                record = dict(p, rules=rules, seed=args.seed)
+                f.write(json.dumps(record) + '\n')
+        mode = 'at'
+
+        num_premises += len(batch)
+        num_rules += sum(len(rules) for rules in results)
+        elapsed = time.time() - start
+        logger.info("{}/{} premises, {:.2f} premises/s, {:.2f} rules/s, eta {:.0f}s".format(
+            num_premises, len(todo), num_premises / elapsed, num_rules / elapsed, (len(todo) - num_premises) * elapsed / num_premises))
+
+    elapsed = time.time() - start
+    logger.info("mined {} rules for {} premises in {:.1f}s ({:.2f} rules/s) into {}".format(
+        num_rules, num_premises, elapsed, num_rules / max(elapsed, 1e-9), args.output))
@@ -0,0 +1,138 @@
+import argparse
+import io
+import itertools
+import json
+import logging
+import sys
+import time
+from argparse import Namespace
+
+import numpy as np
+import torch
+from entailment_eval import EntailmentScorer
+from evaluation import FILES, RelationExtractionEvaluator
+from inductor import BartInductor
+from src.data_reader import read_rule_records
+
+logger = logging.getLogger(__name__)
+
+# metrics that must not drop by more than --max_drop under int8
+CHECKED = ['bleu-1', 'bleu-2', 'bleu-4', 'ROUGE-L', 'entailment score(mean-mean)']
+
+
+class TimedInductor(object):
+    """Stands in for ``evaluator.inductor`` and keeps the latency and output of every call."""
+
+    def __init__(self, inductor):
+        self.inductor = inductor
+        self.latencies = []
+        self.outputs = []
+
+    def generate(self, inputs, k=10, topk=10):
+        start = time.perf_counter()
+        ret = self.inductor.generate(inputs, k=k, topk=topk)
+        self.latencies.append(time.perf_counter() - start)
+        self.outputs.append((inputs, list(ret)))
+        return ret
+
+
+def model_size_mb(model):
+    # serialized size: quantized Linear weights live in packed params, not in parameters()
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2 ** 20
+
+
+def run(evaluator, inductor, records, seed):
+    evaluator.inductor = TimedInductor(inductor)
+    inductor.warmup()
+    torch.manual_seed(seed)
+    metrics = evaluator.evaluate_rows(iter(records))
+    return {name: float(np.mean(values)) if len(values) > 0 else 0.0 for name, values in metrics.items()}, evaluator.inductor
+
+
+def entailment_agreement(evaluator, outputs, scorer):
+    # the generated rules are judged by both classifiers, so this isolates the classifier's own error
+    fp32, int8 = [], []
+    for inputs, hypothesis in outputs:
+        for hypo in hypothesis:
+            hypo = evaluator.clean(hypo.lower().strip())
+            fp32.append(evaluator.entailment_scorer.scoring(inputs, hypo))
+            int8.append(scorer.scoring(inputs, hypo))
+    fp32, int8 = np.array(fp32), np.array(int8)
+    return {
+        'pairs': len(fp32),
+        'mean_abs_diff': float(np.abs(fp32 - int8).mean()) if len(fp32) > 0 else 0.0,
+        'mean_fp32': float(fp32.mean()) if len(fp32) > 0 else 0.0,
+        'mean_int8': float(int8.mean()) if len(int8) > 0 else 0.0,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="accuracy and latency of int8 dynamic quantization against fp32 on CPU")
+    parser.add_argument("--task", type=str, default='openrule155')
+    parser.add_argument("--num_premises", type=int, default=None, help="only the first n premises of the task")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--threads", type=int, default=None, help="torch CPU threads")
+    parser.add_argument("--max_drop", type=float, default=0.02, help="allowed absolute drop of any checked metric")
+    parser.add_argument("--output", type=str, default='quantization_check.json')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+        datefmt='%m/%d/%Y %H:%M:%S',
+        level=logging.WARNING)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    records = list(itertools.islice(read_rule_records(FILES[args.task]), args.num_premises))
+    # the Orion configuration from the README; the fp32 entailment classifier judges both runs
+    evaluator = RelationExtractionEvaluator(Namespace(
+        device='cpu', inductor='rule', group_beam=True, mlm_training=True, bart_training=True, if_then=False, mcgs=True, dpp=True))
+
+    inductors = {'fp32': BartInductor(device='cpu', quantize=False), 'int8': BartInductor(device='cpu', quantize=True)}
+    results = {'config': vars(args), 'num_premises': len(records)}
+    outputs = {}
+    for name, inductor in inductors.items():
+        metrics, timed = run(evaluator, inductor, records, args.seed)
+        latency = np.array(timed.latencies)
+        outputs[name] = timed.outputs
+        results[name] = {
+            'metrics': metrics,
+            'p50_ms': float(np.percentile(latency, 50) * 1000),
+            'p95_ms': float(np.percentile(latency, 95) * 1000),
+            'model_mb': {
+                'instance_generator': model_size_mb(inductor.orion_instance_generator),
+                'hypothesis_generator': model_size_mb(inductor.orion_hypothesis_generator),
+                'dpp_encoder': model_size_mb(inductor.dpp_sampler.model),
+            },
+        }
+
+    int8_scorer = EntailmentScorer('cpu', quantize=True)
+    results['fp32']['model_mb']['entailment_classifier'] = model_size_mb(evaluator.entailment_scorer.model)
+    results['int8']['model_mb']['entailment_classifier'] = model_size_mb(int8_scorer.model)
+    results['entailment_classifier'] = entailment_agreement(evaluator, outputs['fp32'], int8_scorer)
+
+    failed = []
+    for metric in results['fp32']['metrics']:
+        old, new = results['fp32']['metrics'][metric], results['int8']['metrics'][metric]
+        flag = ''
+        if metric in CHECKED and old - new > args.max_drop:
+            flag = '  <-- regression'
+            failed.append(metric)
+            logger.warning("{} dropped from {:.4f} to {:.4f} under int8 (allowed drop {})".format(metric, old, new, args.max_drop))
+        print('{:<32} fp32 {:>7.4f}  int8 {:>7.4f}  delta {:>+8.4f}{}'.format(metric, old, new, new - old, flag))
+    for stat in ('p50_ms', 'p95_ms'):
+        old, new = results['fp32'][stat], results['int8'][stat]
+        print('{:<32} fp32 {:>7.1f}  int8 {:>7.1f}  x{:.2f} faster'.format('latency ' + stat, old, new, old / new))
+    for model in results['fp32']['model_mb']:
+        old, new = results['fp32']['model_mb'][model], results['int8']['model_mb'][model]
+        print('{:<32} fp32 {:>7.0f}  int8 {:>7.0f}  MB'.format(model, old, new))
+    print('entailment classifier: mean |fp32 - int8| {:.4f} over {} pairs'.format(
+        results['entailment_classifier']['mean_abs_diff'], results['entailment_classifier']['pairs']))
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    if failed:
+        logger.error("int8 regression in {}; results written to {}".format(', '.join(failed), args.output))
+        sys.exit(1)
@@ -0,0 +1,232 @@
+import argparse
+import json
+import logging
+import os
+import queue
+import socketserver
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from inductor import BartInductor
+from src.model_registry import set_quantize
+
+logger = logging.getLogger(__name__)
+
+
+class BatchingWorker(threading.Thread):
+    """Single model thread that coalesces queued requests into micro-batches.
+
+    The first queued request opens a batch; further requests are collected for
+    at most ``batch_window`` seconds or until ``max_batch_size`` is reached, and
+    each batch is run through ``BartInductor.generate_batch``. ``submit``
+    raises ``queue.Full`` once ``max_queue`` requests are waiting, and
+    requests that were cancelled or passed their deadline while queued are
+    dropped before they reach the models.
+    """
+
+    def __init__(self, inductor, max_batch_size=8, batch_window=0.02, max_queue=0):
+        super(BatchingWorker, self).__init__(daemon=True)
+        self.inductor = inductor
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+        self.shed = 0
+        self.expired = 0
+        self.busy_seconds = 0.0
+        self.started = time.time()
+
+    def submit(self, premise, k=10, topk=10, timeout=None, seed=None):
+        future = Future()
+        deadline = time.perf_counter() + timeout if timeout is not None else None
+        try:
+            self.queue.put_nowait((premise, k, topk, future, deadline, seed))
+        except queue.Full:
+            with self.lock:
+                self.shed += 1
+            raise
+        return future
+
+    def collect(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            groups = {}
+            now = time.perf_counter()
+            for request in batch:
+                future, deadline = request[3], request[4]
+                if not future.set_running_or_notify_cancel():
+                    continue
+                if deadline is not None and deadline <= now:
+                    with self.lock:
+                        self.expired += 1
+                    future.set_exception(TimeoutError())
+                    continue
+                groups.setdefault((request[1], request[2], request[5]), []).append(request)
+
+            # only requests that reach the models count; cancelled and expired ones were dropped above
+            served = sum(len(requests) for requests in groups.values())
+            if served == 0:
+                continue
+            with self.lock:
+                self.in_flight = served
+            start = time.perf_counter()
+            for (k, topk, seed), requests in groups.items():
+                try:
+                    results = self.inductor.generate_batch([r[0] for r in requests], k=k, topk=topk, seed=seed)
+                except Exception as e:
+                    logger.exception("batch of {} requests failed".format(len(requests)))
+                    with self.lock:
+                        self.errors += len(requests)
+                    for r in requests:
+                        r[3].set_exception(e)
+                    continue
+                for r, rules in zip(requests, results):
+                    r[3].set_result(rules)
+
+            with self.lock:
+                self.busy_seconds += time.perf_counter() - start
+                self.in_flight = 0
+                self.requests += served
+                self.batches += 1
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'in_flight': self.in_flight,
+                'requests': self.requests,
+                'batches': self.batches,
+                'mean_batch_size': self.requests / self.batches if self.batches > 0 else 0.0,
+                'errors': self.errors,
+                'shed': self.shed,
+                'expired': self.expired,
+                'busy_seconds': self.busy_seconds,
+                'uptime_seconds': time.time() - self.started,
+            }
+
+
+class InductorRequestHandler(BaseHTTPRequestHandler):
+    worker = None
+    timeout_seconds = 600
+
+    def address_string(self):
+        # Unix-socket peers have no (host, port) address.
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        elif self.path == '/metrics':
+            self.send_json(200, self.worker.metrics())
+        else:
+            self.send_json(404, {'error': 'unknown path {}'.format(self.path)})
+
+    def do_POST(self):
+        if self.path != '/generate':
+            self.send_json(404, {'error': 'unknown path {}'.format(self.path)})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            premises = body['premises'] if 'premises' in body else [body['premise']]
+            k = int(body.get('k', 10))
+            topk = int(body.get('topk', 10))
+            timeout = float(body.get('timeout', self.timeout_seconds))
+            seed = int(body['seed']) if body.get('seed') is not None else None
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {'error': 'bad request: {}'.format(e)})
+            return
+
+        futures = []
+        try:
+            for premise in premises:
+                futures.append(self.worker.submit(premise, k, topk, timeout, seed))
+        except queue.Full:
+            for future in futures:
+                future.cancel()
+            self.send_json(503, {'error': 'server overloaded'})
+            return
+
+        deadline = time.perf_counter() + timeout
+        try:
+            rules = [future.result(timeout=max(deadline - time.perf_counter(), 0)) for future in futures]
+        except TimeoutError:
+            for future in futures:
+                future.cancel()
+            self.send_json(504, {'error': 'deadline of {}s exceeded'.format(timeout)})
+            return
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+        if 'premises' in body:
+            self.send_json(200, {'rules': rules})
+        else:
+            self.send_json(200, {'rules': rules[0]})
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default='0')
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8008)
+    parser.add_argument("--unix_socket", type=str, default=None, help="serve on this Unix socket instead of TCP")
+    parser.add_argument("--max_batch_size", type=int, default=8)
+    parser.add_argument("--batch_window_ms", type=float, default=20.0)
+    parser.add_argument("--max_queue", type=int, default=256, help="shed requests with 503 beyond this queue depth")
+    parser.add_argument("--quantize", action='store_true', help="int8 dynamic quantization of the models (CPU only)")
+    parser.add_argument("--export_dir", type=str, default=None, help="run group beam search on the graphs exported by src/graph_export.py (CPU only)")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+        datefmt='%m/%d/%Y %H:%M:%S',
+        level=logging.INFO)
+
+    device = args.device if args.device == 'cpu' else 'cuda:' + args.device
+    if args.quantize:
+        set_quantize(True)
+    inductor = BartInductor(device=device, export_dir=args.export_dir)
+    inductor.warmup()
+    worker = BatchingWorker(inductor, args.max_batch_size, args.batch_window_ms / 1000, args.max_queue)
+    worker.start()
+    InductorRequestHandler.worker = worker
+
+    if args.unix_socket is not None:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = ThreadingUnixHTTPServer(args.unix_socket, InductorRequestHandler)
+        logger.info("serving on unix socket {}".format(args.unix_socket))
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), InductorRequestHandler)
+        logger.info("serving on http://{}:{}".format(args.host, args.port))
+    server.serve_forever()
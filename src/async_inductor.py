@@ -0,0 +1,171 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Overloaded(RuntimeError):
+    """Raised when a request is shed because the queue is full."""
+
+
+class AsyncInductor(object):
+    """asyncio front-end for a blocking ``BartInductor``.
+
+    Requests go into a bounded queue consumed by a single coroutine, which
+    groups them into micro-batches and runs ``generate_batch`` on one
+    dedicated thread, so the models only ever see one batch at a time.
+    A full queue sheds the request with ``Overloaded`` instead of queueing it;
+    requests whose deadline passed or whose caller was cancelled while they
+    were queued are dropped before they reach the models.
+    """
+
+    def __init__(self, inductor, max_queue=64, max_batch_size=8, batch_window=0.02):
+        self.inductor = inductor
+        self.max_queue = max_queue
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.worker = None
+        self.loop = None
+        self.batch = []
+        self.shed = 0
+        self.expired = 0
+
+    def start(self):
+        # the queue and the worker belong to the running loop, so they are (re)created on first use in each
+        # loop, e.g. every asyncio.run, and after the worker died
+        loop = asyncio.get_running_loop()
+        if self.worker is None or self.loop is not loop or self.worker.done():
+            self.loop = loop
+            self.batch = []
+            self.queue = asyncio.Queue(maxsize=self.max_queue)
+            self.worker = loop.create_task(self.run())
+
+    async def agenerate(self, inputs, k=10, topk=10, timeout=None, seed=None):
+        self.start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        deadline = loop.time() + timeout if timeout is not None else None
+        try:
+            self.queue.put_nowait((inputs, k, topk, deadline, future, seed))
+        except asyncio.QueueFull:
+            self.shed += 1
+            raise Overloaded("queue is full ({} requests)".format(self.max_queue))
+        # wait_for cancels the future on timeout, which the worker treats as a dropped request
+        return await asyncio.wait_for(future, timeout)
+
+    async def run(self):
+        try:
+            await self.serve()
+        except (Exception, asyncio.CancelledError) as e:
+            # nobody consumes the queue any more: fail every waiting request instead of leaving it hanging;
+            # CancelledError is not an Exception since Python 3.8, so close() is covered separately
+            if isinstance(e, asyncio.CancelledError):
+                e = RuntimeError("AsyncInductor was closed")
+            waiting = list(self.batch)
+            while not self.queue.empty():
+                waiting.append(self.queue.get_nowait())
+            for request in waiting:
+                if not request[4].done():
+                    request[4].set_exception(e)
+            raise
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.batch = batch = [await self.queue.get()]
+            if self.batch_window > 0 and self.queue.empty():
+                await asyncio.sleep(self.batch_window)
+            while len(batch) < self.max_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            groups = {}
+            now = loop.time()
+            for request in batch:
+                future, deadline = request[4], request[3]
+                if future.done():
+                    continue
+                if deadline is not None and deadline <= now:
+                    self.expired += 1
+                    future.set_exception(asyncio.TimeoutError())
+                    continue
+                groups.setdefault((request[1], request[2], request[5]), []).append(request)
+
+            for (k, topk, seed), requests in groups.items():
+                try:
+                    results = await loop.run_in_executor(
+                        self.executor, self.inductor.generate_batch, [r[0] for r in requests], k, topk, seed)
+                except Exception as e:
+                    for r in requests:
+                        if not r[4].done():
+                            r[4].set_exception(e)
+                    continue
+                for r, rules in zip(requests, results):
+                    if not r[4].done():
+                        r[4].set_result(rules)
+
+    def metrics(self):
+        return {
+            'queue_depth': self.queue.qsize() if self.queue is not None else 0,
+            'shed': self.shed,
+            'expired': self.expired,
+        }
+
+    async def close(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+        self.executor.shutdown(wait=False)
+
+
+class AsyncClient(object):
+    """Minimal asyncio client for ``server.py`` (TCP or Unix socket)."""
+
+    def __init__(self, host='127.0.0.1', port=8008, unix_socket=None):
+        self.host = host
+        self.port = port
+        self.unix_socket = unix_socket
+
+    async def request(self, method, path, body=None, timeout=None):
+        return await asyncio.wait_for(self._request(method, path, body), timeout)
+
+    async def _request(self, method, path, body=None):
+        if self.unix_socket is not None:
+            reader, writer = await asyncio.open_unix_connection(self.unix_socket)
+        else:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            data = json.dumps(body).encode('utf-8') if body is not None else b''
+            head = '{} {} HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(
+                method, path, self.host, len(data))
+            writer.write(head.encode('utf-8') + data)
+            await writer.drain()
+            response = await reader.read()
+        finally:
+            writer.close()
+
+        header, _, payload = response.partition(b'\r\n\r\n')
+        status = int(header.split(b' ', 2)[1])
+        result = json.loads(payload.decode('utf-8')) if payload else {}
+        if status == 503:
+            raise Overloaded(result.get('error', 'server overloaded'))
+        if status != 200:
+            raise RuntimeError('{} {} failed with {}: {}'.format(method, path, status, result.get('error')))
+        return result
+
+    async def generate(self, premise, k=10, topk=10, timeout=None, seed=None):
+        body = {'premise': premise, 'k': k, 'topk': topk}
+        if seed is not None:
+            body['seed'] = seed
+        result = await self.request('POST', '/generate', body, timeout)
+        return result['rules']
+
+    async def health(self, timeout=None):
+        return await self.request('GET', '/health', timeout=timeout)
+
+    async def metrics(self, timeout=None):
+        return await self.request('GET', '/metrics', timeout=timeout)
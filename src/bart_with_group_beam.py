@@ -13,6 +13,21 @@ import torch.nn
 BeamSearchOutput = Union[BeamSearchEncoderDecoderOutput, BeamSearchDecoderOnlyOutput]
 
 
+def shared_group_scores(next_token_scores, ori_input_ids, group_size, vocab_size):
+    """Orion's cross-sentence candidate scores.
+
+    ``next_token_scores`` is (batch_size, group_size * vocab_size). Every
+    sentence ranks candidates by their mean score over the batch, except the
+    tokens of its own input (``ori_input_ids[i]``, in every beam of the group),
+    which keep the sentence's own score.
+    """
+    batch_size = next_token_scores.size(0)
+    mean = torch.sum(next_token_scores, dim=0, keepdim=True).expand(batch_size, -1) / batch_size
+    own = torch.zeros((batch_size, vocab_size), dtype=torch.bool, device=next_token_scores.device)
+    own.scatter_(1, ori_input_ids.to(next_token_scores.device), True)
+    return torch.where(own.repeat(1, group_size), next_token_scores, mean)
+
+
 class BartForConditionalGeneration_GroupBeam(BartForConditionalGeneration):
 
 
@@ -205,16 +220,9 @@ class BartForConditionalGeneration_GroupBeam(BartForConditionalGeneration):
             #m = torch.nn.LayerNorm(num_beams * vocab_size)
             #next_token_scores = m(next_token_scores)
 
-            next_token_scores_group = torch.sum(next_token_scores,dim=0,keepdim=True).expand(batch_size,-1) / batch_size
-
-            for i in range(next_token_scores.size(0)):
-                '''tmin = torch.min(next_token_scores_group[i])
-                for j in range(1,len(model_kwargs['decoder_ori_input_ids'][i])):
-                    next_token_scores_group[i][model_kwargs['decoder_ori_input_ids'][i][j]] = tmin'''
-                for t in model_kwargs['decoder_ori_input_ids'][i]:
-                    for j in range(num_beams):
-                    #if t not in input_ids[i] or t==1:
-                        next_token_scores_group[i][j * vocab_size + t] = next_token_scores[i][j * vocab_size + t]
+            next_token_scores_group = shared_group_scores(
+                next_token_scores, model_kwargs['decoder_ori_input_ids'], num_beams, vocab_size
+            )
 
             next_token_scores, next_tokens = torch.topk(
                 next_token_scores_group, 2 * num_beams, dim=1, largest=True, sorted=True)
@@ -293,6 +301,26 @@ class BartForConditionalGeneration_GroupBeam(BartForConditionalGeneration):
         else:
             return sequence_outputs["sequences"]
 
+    @staticmethod
+    def _decoder_rows(input_ids, active_rows, num_beams, share_prefix):
+        """Rows the decoder runs on this step, and every row's position among them (-1 for inactive rows)."""
+        row_pos = torch.full((input_ids.size(0),), -1, dtype=torch.long, device=input_ids.device)
+        if not share_prefix:
+            row_pos[active_rows] = torch.arange(active_rows.size(0), device=input_ids.device)
+            return active_rows, row_pos
+        # same sentence and same decoder prefix means the same past and the same next-token logits
+        keys = torch.cat([(active_rows // num_beams).unsqueeze(-1), input_ids[active_rows]], dim=-1)
+        unique_keys, inverse = torch.unique(keys, dim=0, return_inverse=True)
+        # any row of a duplicate set can stand for it
+        decoder_rows = torch.empty(unique_keys.size(0), dtype=torch.long, device=input_ids.device).scatter_(0, inverse, active_rows)
+        row_pos[active_rows] = inverse
+        return decoder_rows, row_pos
+
+    @staticmethod
+    def _select_cache(past, index):
+        # unlike _reorder_cache, also selects the cross-attention states: dropping rows changes the batch
+        return tuple(tuple(past_state.index_select(0, index) for past_state in layer_past) for layer_past in past)
+
     def group_beam_search(
         self,
         input_ids: torch.LongTensor,
@@ -447,15 +475,44 @@ class BartForConditionalGeneration_GroupBeam(BartForConditionalGeneration):
         beam_scores[:, ::num_sub_beams] = 0
         beam_scores = beam_scores.view((batch_size * num_beams,))
 
+        # adaptive decoding: a group retires once its best continuation is EOS for every unfinished sentence, and
+        # its rows are dropped from the decoder batch for the remaining steps. Retired rows keep a -1e9 score, so
+        # the hypothesis each retired group already added always outranks them in finalize.
+        adaptive = model_kwargs.pop("decoder_adaptive", False)
+        # prefix sharing: rows of one sentence with identical decoder prefixes are run once per step
+        share_prefix = model_kwargs.pop("decoder_share_prefix", False)
+        # either way the decoder runs on a subset of the rows and the cache follows that subset
+        compact = adaptive or share_prefix
+        group_active = [True] * num_beam_groups
+        active_rows = torch.arange(batch_size * num_beams, device=device)
+        if compact:
+            encoder_outputs = model_kwargs["encoder_outputs"]
+            attention_mask = model_kwargs.get("attention_mask")
+            # position of every row's cache in the previous step's decoder batch
+            cache_pos = None
+
         while cur_len < max_length:
             # predicted tokens in cur_len step
             current_tokens = torch.zeros(batch_size * num_beams, dtype=input_ids.dtype, device=device)
+            if adaptive and pad_token_id is not None:
+                current_tokens.fill_(pad_token_id)
 
             # indices which will form the beams in the next time step
             reordering_indices = torch.zeros(batch_size * num_beams, dtype=torch.long, device=device)
 
             # do one decoder step on all beams of all sentences in batch
-            model_inputs = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
+            if compact:
+                decoder_rows, row_pos = self._decoder_rows(input_ids, active_rows, num_beams, share_prefix)
+                if model_kwargs.get("past") is not None:
+                    model_kwargs["past"] = self._select_cache(model_kwargs["past"], cache_pos[decoder_rows])
+                model_kwargs["encoder_outputs"] = encoder_outputs.__class__(
+                    last_hidden_state=encoder_outputs.last_hidden_state.index_select(0, decoder_rows)
+                )
+                if attention_mask is not None:
+                    model_kwargs["attention_mask"] = attention_mask.index_select(0, decoder_rows)
+                model_inputs = self.prepare_inputs_for_generation(input_ids.index_select(0, decoder_rows), **model_kwargs)
+            else:
+                model_inputs = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
             outputs = self(
                 **model_inputs,
                 return_dict=True,
@@ -463,7 +520,10 @@ class BartForConditionalGeneration_GroupBeam(BartForConditionalGeneration):
                 output_hidden_states=output_hidden_states,
             )
 
+            group_finished = []
             for beam_group_idx in range(num_beam_groups):
+                if not group_active[beam_group_idx]:
+                    continue
                 group_start_idx = beam_group_idx * num_sub_beams
                 group_end_idx = min(group_start_idx + num_sub_beams, num_beams)
                 group_size = group_end_idx - group_start_idx
@@ -472,7 +532,7 @@ class BartForConditionalGeneration_GroupBeam(BartForConditionalGeneration):
                 batch_group_indices = []
 
                 if output_scores:
-                    processed_score = torch.zeros_like(outputs.logits[:, -1, :]).half()  # .float()
+                    processed_score = outputs.logits.new_zeros((batch_size * num_beams, outputs.logits.size(-1))).half()  # .float()
 
                 for batch_idx in range(batch_size):
                     batch_group_indices.extend(
@@ -481,7 +541,10 @@ class BartForConditionalGeneration_GroupBeam(BartForConditionalGeneration):
                 group_input_ids = input_ids[batch_group_indices]
 
                 # select outputs of beams of current group only
-                next_token_logits = outputs.logits[batch_group_indices, -1, :]
+                if compact:
+                    next_token_logits = outputs.logits[row_pos[batch_group_indices], -1, :]
+                else:
+                    next_token_logits = outputs.logits[batch_group_indices, -1, :]
 
                 # adjust tokens for Bart, *e.g.*
                 next_token_logits = self.adjust_logits_during_generation(
@@ -505,17 +568,9 @@ class BartForConditionalGeneration_GroupBeam(BartForConditionalGeneration):
                 next_token_scores = next_token_scores.view(batch_size, group_size * vocab_size)
                 ###
 
-                next_token_scores_group = torch.sum(next_token_scores, dim=0, keepdim=True).expand(batch_size,
-                                                                                                   -1) / batch_size
-
-                for i in range(next_token_scores.size(0)):
-                    '''tmin = torch.min(next_token_scores_group[i])
-                    for j in range(1,len(model_kwargs['decoder_ori_input_ids'][i])):
-                        next_token_scores_group[i][model_kwargs['decoder_ori_input_ids'][i][j]] = tmin'''
-                    for t in model_kwargs['decoder_ori_input_ids'][i]:
-                        for j in range(group_size):
-                            # if t not in input_ids[i] or t==1:
-                            next_token_scores_group[i][j * vocab_size + t] = next_token_scores[i][j * vocab_size + t]
+                next_token_scores_group = shared_group_scores(
+                    next_token_scores, model_kwargs['decoder_ori_input_ids'], group_size, vocab_size
+                )
 
                 next_token_scores, next_tokens = torch.topk(
                     next_token_scores_group, 2 * group_size, dim=1, largest=True, sorted=True)
@@ -552,6 +607,10 @@ class BartForConditionalGeneration_GroupBeam(BartForConditionalGeneration):
                     num_beams * (beam_idx // group_size) + group_start_idx + (beam_idx % group_size)
                 )
 
+                if adaptive and eos_token_id is not None:
+                    # the group's top-ranked candidate ended as a hypothesis in every sentence that is still open
+                    group_finished.append(((next_tokens[:, 0] == eos_token_id) | beam_scorer._done).all())
+
             # Store scores, attentions and hidden_states when required
             if return_dict_in_generate:
                 if output_scores:
@@ -571,12 +630,25 @@ class BartForConditionalGeneration_GroupBeam(BartForConditionalGeneration):
             model_kwargs = self._update_model_kwargs_for_generation(
                 outputs, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
             )
-            if model_kwargs["past"] is not None:
+            if compact:
+                # reordering stays inside a group, so active rows take their cache from active rows
+                cache_pos = row_pos[reordering_indices]
+                # one host sync per step for all groups
+                group_finished = torch.stack(group_finished).tolist() if group_finished else []
+                running = [g for g in range(num_beam_groups) if group_active[g]]
+                retired = [g for g, finished in zip(running, group_finished) if finished]
+                if retired:
+                    for group in retired:
+                        group_active[group] = False
+                    rows = torch.arange(batch_size * num_beams, device=device).view(batch_size, num_beam_groups, num_sub_beams)
+                    beam_scores[rows[:, retired].reshape(-1)] = -1e9
+                    active_rows = rows[:, [g for g in running if group_active[g]]].reshape(-1)
+            elif model_kwargs["past"] is not None:
                 model_kwargs["past"] = self._reorder_cache(model_kwargs["past"], reordering_indices)
 
             input_ids = torch.cat([input_ids, current_tokens.unsqueeze(-1)], dim=-1)
             cur_len = cur_len + 1
-            if beam_scorer.is_done:
+            if beam_scorer.is_done or not any(group_active):
                 break
 
         sequence_outputs = beam_scorer.finalize(
@@ -0,0 +1,138 @@
+import ast
+import hashlib
+import os
+import pickle
+import re
+from collections import namedtuple
+
+# premise, head and tail entities, and the reference relations; is_list tells
+# the "['<A> ... <B>.', ...]" form from a single "[X] ... [Y]" relation
+RuleRecord = namedtuple('RuleRecord', ['inputs', 'head', 'tail', 'relations', 'is_list'])
+# one line of the ExpBERT disease / spouse datasets; label is 1 or -1
+REExample = namedtuple('REExample', ['sentence', 'entity1', 'entity2', 'id', 'label'])
+# one mined KB rule "body => head" over the variables (a, b); a body written on (b, a)
+# has inverted=True; stats holds the miner's measures (RuLES: hc, conf, ...), empty for AMIE
+KBRule = namedtuple('KBRule', ['rule', 'body', 'head', 'inverted', 'stats'])
+
+CACHE_VERSION = 1
+
+cache_dir = os.environ.get('ORION_DATA_CACHE')
+
+
+def set_cache_dir(path):
+    """Keep parsed copies of data files under ``path``; ``None`` always parses the text."""
+    global cache_dir
+    cache_dir = path
+
+
+def parse_rule_row(line):
+    row = line.strip().split('\t')
+    inputs, head, tail, relations = row[0], row[1], row[2], row[3]
+    if relations.startswith('[') and relations.endswith(']'):
+        return RuleRecord(inputs.strip(), head, tail, ast.literal_eval(relations), True)
+    return RuleRecord(inputs.strip(), head, tail, [relations], False)
+
+
+def parse_re_row(line):
+    sentence, entity1, entity2, id, label = line.strip().split('\t')
+    return REExample(sentence, entity1, entity2, id, ast.literal_eval(label))
+
+
+AMIE_ATOM = re.compile(r'^\s*(?P<subject>\w+)\s*<(?P<relation>\w+)>\s*(?P<object>\w+)\s*$')
+RULES_ATOM = re.compile(r'^\s*<(?P<relation>\w+)>\((?P<subject>\w+),\s*(?P<object>\w+)\)\s*$')
+
+
+def _kb_atom(pattern, text):
+    match = pattern.match(text)
+    if match is None:
+        raise ValueError('cannot parse KB rule atom {!r}'.format(text))
+    return match.group('relation'), match.group('subject'), match.group('object')
+
+
+def parse_kb_row(line):
+    """Parse an AMIE ("a <r1> b => a <r2> b") or RuLES ("<r2>(V0, V1) :- <r1>(V0, V1)\\tconf: ...") rule."""
+    row = line.strip().lstrip('\ufeff').split('\t')
+    if '=>' in row[0]:
+        body, head = (_kb_atom(AMIE_ATOM, atom) for atom in row[0].split('=>'))
+    else:
+        head, body = (_kb_atom(RULES_ATOM, atom) for atom in row[0].split(':-'))
+    stats = {}
+    for name, value in zip(row[1::2], row[2::2]):
+        stats[name.strip().rstrip(':')] = ast.literal_eval(value.strip())
+    # both formats write the head on (first, second) variable
+    return KBRule(row[0].strip(), body[0], head[0], body[1] != head[1], stats)
+
+
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_path(path, parse):
+    name = '{}.{}.v{}.{}.pkl'.format(os.path.basename(path), parse.__name__, CACHE_VERSION, file_hash(path))
+    return os.path.join(cache_dir, name)
+
+
+def _parse_lines(path, parse):
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                yield parse(line)
+
+
+def _load_pickled(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def _parse_and_cache(path, parse, target):
+    # records are pickled one by one so neither writing nor reading holds the file in memory;
+    # the cache only appears under its final name once it is complete
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    tmp = '{}.{}.tmp'.format(target, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            for record in _parse_lines(path, parse):
+                pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+                yield record
+        os.replace(tmp, target)
+    finally:
+        # the reader stopped early (or failed): drop the partial file
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def read_records(path, parse):
+    """Lazily yield ``parse(line)`` for every non-empty line of ``path``.
+
+    With a cache directory set, the first full pass also writes the parsed
+    records there, keyed by the file's content hash; later passes stream the
+    records back without re-parsing. Editing the file changes the hash, so
+    stale caches are never read.
+    """
+    if cache_dir is None:
+        return _parse_lines(path, parse)
+    target = cache_path(path, parse)
+    if os.path.isfile(target):
+        return _load_pickled(target)
+    return _parse_and_cache(path, parse, target)
+
+
+def read_rule_records(path):
+    return read_records(path, parse_rule_row)
+
+
+def read_re_examples(path):
+    return read_records(path, parse_re_row)
+
+
+def read_kb_rules(path):
+    return read_records(path, parse_kb_row)
@@ -0,0 +1,102 @@
+import threading
+from collections import OrderedDict
+
+import torch
+import torch.nn.functional as F
+
+
+class EmbeddingCache(object):
+    """LRU cache of L2-normalized sentence vectors in front of a batched ``embed_fn``.
+
+    ``embed_fn`` takes a list of ``[text, score]`` pairs (the format used
+    throughout ``DPPsampler``) and returns one row per pair. Only texts that
+    are not cached are embedded, in a single call. Vectors are kept as
+    float32 on the CPU, so the default ``max_size`` holds about 60 MB of
+    768-dimensional BERT vectors.
+    """
+
+    def __init__(self, embed_fn, max_size=20000):
+        self.embed_fn = embed_fn
+        self.max_size = max_size
+        self.vectors = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, texts):
+        # cached vectors are taken while the lock is held, so a concurrent eviction cannot remove them in between
+        found = {}
+        with self.lock:
+            for text in texts:
+                vector = self.vectors.get(text)
+                if vector is not None:
+                    self.vectors.move_to_end(text)
+                    found[text] = vector
+            missing = list(dict.fromkeys(t for t in texts if t not in found))
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        if len(missing) > 0:
+            vectors = F.normalize(self.embed_fn([[t, 0] for t in missing]).float(), dim=1).cpu()
+            with self.lock:
+                for i, text in enumerate(missing):
+                    found[text] = vectors[i]
+                    self.vectors[text] = vectors[i]
+                    self.vectors.move_to_end(text)
+                while len(self.vectors) > self.max_size:
+                    self.vectors.popitem(last=False)
+        return torch.stack([found[text] for text in texts])
+
+
+class LSHIndex(object):
+    """Random-hyperplane LSH for cosine similarity.
+
+    Every vector gets ``num_tables`` codes of ``num_bits`` sign bits each;
+    vectors sharing a code in any table are candidate neighbours.
+    """
+
+    def __init__(self, dim, num_bits=8, num_tables=10, seed=0):
+        generator = torch.Generator()
+        generator.manual_seed(seed)
+        self.num_bits = num_bits
+        self.num_tables = num_tables
+        self.planes = torch.randn(dim, num_bits * num_tables, generator=generator)
+        self.powers = 2 ** torch.arange(num_bits)
+        self.tables = [{} for _ in range(num_tables)]
+
+    def hash(self, vectors):
+        bits = (torch.matmul(vectors, self.planes) > 0).long().reshape(-1, self.num_tables, self.num_bits)
+        return (bits * self.powers).sum(dim=2).tolist()
+
+    def candidates(self, codes):
+        ret = set()
+        for table, code in zip(self.tables, codes):
+            ret.update(table.get(code, ()))
+        return ret
+
+    def add(self, i, codes):
+        for table, code in zip(self.tables, codes):
+            table.setdefault(code, []).append(i)
+
+
+def semantic_dedup(vectors, scores, threshold=0.9, num_bits=8, num_tables=10, seed=0):
+    """Greedy near-duplicate removal over L2-normalized ``vectors``.
+
+    Items are visited from the highest score down; an item is dropped when its
+    cosine similarity to an already kept LSH candidate reaches ``threshold``.
+    Returns the indices of the kept items in their original order. Apart from
+    the sort, each item only compares against its bucket mates, so the cost
+    grows with n log n rather than n^2 as long as near-duplicate groups are
+    small.
+    """
+    if len(scores) == 0:
+        return []
+    index = LSHIndex(vectors.size(1), num_bits, num_tables, seed)
+    codes = index.hash(vectors)
+    kept = []
+    for i in sorted(range(len(scores)), key=lambda i: scores[i], reverse=True):
+        candidates = list(index.candidates(codes[i]))
+        if len(candidates) > 0 and torch.matmul(vectors[candidates], vectors[i]).max().item() >= threshold:
+            continue
+        index.add(i, codes[i])
+        kept.append(i)
+    return sorted(kept)
@@ -0,0 +1,214 @@
+import argparse
+import os
+
+import torch
+from transformers import BartConfig
+from transformers.generation_utils import GenerationMixin
+from transformers.modeling_outputs import BaseModelOutput, Seq2SeqLMOutput
+from transformers.models.bart import BartForConditionalGeneration
+
+from src.bart_with_group_beam import BartForConditionalGeneration_GroupBeam
+from src.model_registry import quantize_dynamic
+
+# the encoder, the first decoder step (no cache yet) and every later step (self- and cross-attention cache)
+GRAPHS = ['encoder', 'decoder_init', 'decoder_step']
+EXTENSIONS = {'torchscript': '.pt', 'onnx': '.onnx'}
+# tensors per decoder layer in the cache: self-attention key, value, cross-attention key, value
+CACHE_TENSORS = 4
+
+
+def flatten_past(past):
+    return tuple(tensor for layer in past for tensor in layer)
+
+
+def unflatten_past(flat):
+    return tuple(tuple(flat[i:i + CACHE_TENSORS]) for i in range(0, len(flat), CACHE_TENSORS))
+
+
+class EncoderGraph(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.encoder = model.get_encoder()
+
+    def forward(self, input_ids, attention_mask):
+        return self.encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=False)[0]
+
+
+class DecoderGraph(torch.nn.Module):
+    """One decoder step: logits of the last position, then the flattened cache (see ``flatten_past``)."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.decoder = model.get_decoder()
+        self.lm_head = model.lm_head
+        self.register_buffer('final_logits_bias', model.final_logits_bias)
+
+    def forward(self, decoder_input_ids, encoder_hidden_states, attention_mask, *past):
+        outputs = self.decoder(
+            input_ids=decoder_input_ids,
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=attention_mask,
+            past_key_values=unflatten_past(past) if past else None,
+            use_cache=True,
+            return_dict=False,
+        )
+        logits = self.lm_head(outputs[0][:, -1:, :]) + self.final_logits_bias
+        return (logits,) + flatten_past(outputs[1])
+
+
+def cache_names(prefix, num_layers):
+    return ['{}_{}_{}'.format(prefix, layer, name) for layer in range(num_layers)
+            for name in ('self_key', 'self_value', 'cross_key', 'cross_value')]
+
+
+def input_names(graph, num_layers):
+    if graph == 'encoder':
+        return ['input_ids', 'attention_mask']
+    names = ['decoder_input_ids', 'encoder_hidden_states', 'attention_mask']
+    return names + cache_names('past', num_layers) if graph == 'decoder_step' else names
+
+
+def export(path, out_dir, backend='torchscript', quantize=False, opset_version=12):
+    """Trace the encoder and the two decoder steps of ``path`` on CPU into ``out_dir``, next to its config.
+
+    ``quantize`` applies int8 dynamic quantization (see ``model_registry``) before
+    tracing; only TorchScript can hold the quantized linear layers.
+    """
+    if quantize and backend != 'torchscript':
+        raise ValueError('quantized graphs can only be exported with the torchscript backend')
+    model = BartForConditionalGeneration.from_pretrained(path).eval()
+    model.config.use_cache = True
+    if quantize:
+        model = quantize_dynamic(model)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    model.config.save_pretrained(out_dir)
+
+    # example inputs: batch and lengths above 1 so no dimension is specialized as a broadcast
+    bos, eos, pad = model.config.bos_token_id, model.config.eos_token_id, model.config.pad_token_id
+    input_ids = torch.tensor([[bos, 4, 5, 6, eos], [bos, 7, 8, eos, pad]])
+    attention_mask = input_ids.ne(pad).long()
+    decoder_input_ids = torch.full((2, 1), model.config.decoder_start_token_id, dtype=torch.long)
+    encoder, decoder = EncoderGraph(model).eval(), DecoderGraph(model).eval()
+    with torch.no_grad():
+        hidden = encoder(input_ids, attention_mask)
+        past = decoder(decoder_input_ids, hidden, attention_mask)[1:]
+        past = decoder(decoder_input_ids, hidden, attention_mask, *past)[1:]
+    examples = {
+        'encoder': (encoder, (input_ids, attention_mask)),
+        'decoder_init': (decoder, (decoder_input_ids, hidden, attention_mask)),
+        'decoder_step': (decoder, (decoder_input_ids, hidden, attention_mask) + tuple(past)),
+    }
+
+    num_layers = model.config.decoder_layers
+    for name in GRAPHS:
+        module, inputs = examples[name]
+        target = os.path.join(out_dir, name + EXTENSIONS[backend])
+        with torch.no_grad():
+            if backend == 'torchscript':
+                torch.jit.save(torch.jit.trace(module, inputs, check_trace=False), target)
+                continue
+            if name == 'encoder':
+                output_names = ['last_hidden_state']
+                dynamic_axes = {'input_ids': {0: 'batch', 1: 'source'}, 'attention_mask': {0: 'batch', 1: 'source'},
+                                'last_hidden_state': {0: 'batch', 1: 'source'}}
+            else:
+                output_names = ['logits'] + cache_names('present', num_layers)
+                dynamic_axes = {'decoder_input_ids': {0: 'batch'}, 'encoder_hidden_states': {0: 'batch', 1: 'source'},
+                                'attention_mask': {0: 'batch', 1: 'source'}, 'logits': {0: 'batch'}}
+                for present in cache_names('present', num_layers):
+                    dynamic_axes[present] = {0: 'batch', 2: 'source' if 'cross' in present else 'target'}
+                if name == 'decoder_step':
+                    for past_name in cache_names('past', num_layers):
+                        dynamic_axes[past_name] = {0: 'batch', 2: 'source' if 'cross' in past_name else 'past'}
+            torch.onnx.export(module, inputs, target, input_names=input_names(name, num_layers), output_names=output_names,
+                              dynamic_axes=dynamic_axes, opset_version=opset_version)
+    return out_dir
+
+
+class TorchScriptGraphs(object):
+    def __init__(self, export_dir):
+        self.modules = {name: torch.jit.load(os.path.join(export_dir, name + EXTENSIONS['torchscript']), map_location='cpu')
+                        for name in GRAPHS}
+
+    def run(self, name, *inputs):
+        outputs = self.modules[name](*inputs)
+        return outputs if isinstance(outputs, tuple) else (outputs,)
+
+
+class OnnxGraphs(object):
+    def __init__(self, export_dir, num_layers, threads=None):
+        import onnxruntime
+
+        self.num_layers = num_layers
+        options = onnxruntime.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        self.sessions = {
+            name: onnxruntime.InferenceSession(os.path.join(export_dir, name + EXTENSIONS['onnx']), options,
+                                               providers=['CPUExecutionProvider'])
+            for name in GRAPHS
+        }
+
+    def run(self, name, *inputs):
+        session = self.sessions[name]
+        # the exporter drops unused inputs, e.g. the encoder states once the cross-attention cache exists
+        used = set(arg.name for arg in session.get_inputs())
+        feed = {arg: tensor.numpy() for arg, tensor in zip(input_names(name, self.num_layers), inputs) if arg in used}
+        return tuple(torch.from_numpy(output) for output in session.run(None, feed))
+
+
+class ExportedGroupBeam(GenerationMixin):
+    """Stands in for ``BartForConditionalGeneration_GroupBeam`` on CPU, with the network replaced by
+    the graphs written by ``export``.
+
+    ``generate`` and the custom ``group_beam_search`` / ``beam_search`` are the in-tree ones; only
+    the encoder call and the decoder step (``__call__``) go through TorchScript or ONNX Runtime.
+    The backend is picked from the files in ``export_dir``.
+    """
+
+    device = torch.device('cpu')
+    beam_search = BartForConditionalGeneration_GroupBeam.beam_search
+    group_beam_search = BartForConditionalGeneration_GroupBeam.group_beam_search
+    prepare_inputs_for_generation = BartForConditionalGeneration.prepare_inputs_for_generation
+    _decoder_rows = staticmethod(BartForConditionalGeneration_GroupBeam._decoder_rows)
+    _select_cache = staticmethod(BartForConditionalGeneration_GroupBeam._select_cache)
+    _reorder_cache = staticmethod(BartForConditionalGeneration._reorder_cache)
+
+    def __init__(self, export_dir, threads=None):
+        self.config = BartConfig.from_pretrained(export_dir)
+        if os.path.isfile(os.path.join(export_dir, 'encoder' + EXTENSIONS['onnx'])):
+            self.graphs = OnnxGraphs(export_dir, self.config.decoder_layers, threads)
+        else:
+            self.graphs = TorchScriptGraphs(export_dir)
+
+    def get_encoder(self):
+        return self.encode
+
+    def encode(self, input_ids, attention_mask=None, **kwargs):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        return BaseModelOutput(last_hidden_state=self.graphs.run('encoder', input_ids, attention_mask.long())[0])
+
+    def __call__(self, encoder_outputs=None, past_key_values=None, decoder_input_ids=None, attention_mask=None, **kwargs):
+        hidden = encoder_outputs.last_hidden_state
+        if attention_mask is None:
+            attention_mask = torch.ones(hidden.shape[:2], dtype=torch.long)
+        if past_key_values is None:
+            outputs = self.graphs.run('decoder_init', decoder_input_ids, hidden, attention_mask.long())
+        else:
+            outputs = self.graphs.run('decoder_step', decoder_input_ids, hidden, attention_mask.long(),
+                                      *flatten_past(past_key_values))
+        return Seq2SeqLMOutput(logits=outputs[0], past_key_values=unflatten_past(outputs[1:]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="export the hypothesis generator for group beam search on TorchScript or ONNX Runtime")
+    parser.add_argument("--out_dir", type=str, required=True)
+    parser.add_argument("--model", type=str, default='chenxran/orion-hypothesis-generator')
+    parser.add_argument("--backend", type=str, default='torchscript', choices=sorted(EXTENSIONS))
+    parser.add_argument("--quantize", action='store_true', help="int8 dynamic quantization before tracing (torchscript only)")
+    parser.add_argument("--opset", type=int, default=12, help="ONNX opset version")
+    args = parser.parse_args()
+
+    print('exported {} to {}'.format(args.model, export(args.model, args.out_dir, args.backend, args.quantize, args.opset)))
@@ -0,0 +1,156 @@
+import argparse
+import os
+import threading
+
+import torch
+
+_MODELS = {}
+_TOKENIZERS = {}
+_LOCK = threading.RLock()
+
+SAFETENSORS_NAME = 'model.safetensors'
+DEFAULT_EXPORTS = [
+    'BartForConditionalGeneration=chenxran/orion-instance-generator',
+    'BartForConditionalGeneration=chenxran/orion-hypothesis-generator',
+    'BertModel=bert-base-uncased',
+    'GPT2LMHeadModel=gpt2',
+    'BartForSequenceClassification=geckos/bart-fined-tuned-on-entailment-classification',
+]
+
+checkpoint_dir = os.environ.get('ORION_CHECKPOINT_DIR')
+quantize_cpu = os.environ.get('ORION_QUANTIZE') == '1'
+
+
+def is_cuda(device):
+    return 'cpu' not in str(device)
+
+
+def set_checkpoint_dir(path):
+    """Look for safetensors exports (see ``export``) under ``path`` before downloading from the hub."""
+    global checkpoint_dir
+    checkpoint_dir = path
+
+
+def set_quantize(flag):
+    """Default for ``get_model(quantize=None)``: int8 dynamic quantization of CPU models."""
+    global quantize_cpu
+    quantize_cpu = flag
+
+
+def quantize_dynamic(model):
+    # int8 weights, activations quantized on the fly; in place so memory-mapped embeddings stay shared
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def local_checkpoint(path):
+    if os.path.isfile(os.path.join(path, SAFETENSORS_NAME)):
+        return path
+    if checkpoint_dir is not None:
+        local = os.path.join(checkpoint_dir, path.replace('/', '--'))
+        if os.path.isfile(os.path.join(local, SAFETENSORS_NAME)):
+            return local
+    return None
+
+
+def load_safetensors(model_class, path):
+    """Build ``model_class`` with its weights memory-mapped from ``path/model.safetensors``.
+
+    The tensors are backed by a private mapping of the file, so every process
+    (forked or not) that loads the same checkpoint read-only shares its pages
+    through the page cache instead of holding a private copy.
+    """
+    from safetensors import safe_open
+
+    model = model_class(model_class.config_class.from_pretrained(path))
+    with safe_open(os.path.join(path, SAFETENSORS_NAME), framework='pt', device='cpu') as f:
+        for name in f.keys():
+            *module_path, attr = name.split('.')
+            module = model
+            for part in module_path:
+                module = getattr(module, part)
+            tensor = f.get_tensor(name)
+            if attr in module._parameters:
+                module._parameters[attr] = torch.nn.Parameter(tensor, requires_grad=False)
+            else:
+                module._buffers[attr] = tensor
+    # tied weights are exported once; re-tie the output embeddings to the loaded input embeddings
+    model.tie_weights()
+    return model.eval()
+
+
+def get_model(model_class, path, device, half=False, quantize=None):
+    """Load ``model_class`` from ``path`` once per process and share it.
+
+    Models are cached by (class, path, device, half, quantize), put in eval
+    mode and moved to ``device``; ``half`` is only applied on CUDA devices and
+    ``quantize`` (``None``: see ``set_quantize``) only on CPU, where it swaps
+    every ``nn.Linear`` for an int8 dynamically quantized one. On CPU a
+    safetensors export of ``path`` is memory-mapped when one is available.
+    Callers must treat the returned model as read-only.
+    """
+    half = half and is_cuda(device)
+    quantize = (quantize_cpu if quantize is None else quantize) and not is_cuda(device)
+    key = (model_class.__name__, path, str(device), half, quantize)
+    with _LOCK:
+        if key not in _MODELS:
+            local = local_checkpoint(path)
+            if local is not None and not is_cuda(device):
+                model = load_safetensors(model_class, local)
+            else:
+                model = model_class.from_pretrained(path).eval().to(device)
+            if half:
+                model = model.half()
+            if quantize:
+                model = quantize_dynamic(model)
+            _MODELS[key] = model
+        return _MODELS[key]
+
+
+def get_tokenizer(tokenizer_class, path):
+    key = (tokenizer_class.__name__, path)
+    with _LOCK:
+        if key not in _TOKENIZERS:
+            _TOKENIZERS[key] = tokenizer_class.from_pretrained(path)
+        return _TOKENIZERS[key]
+
+
+def loaded_models():
+    with _LOCK:
+        return list(_MODELS.keys())
+
+
+def clear():
+    with _LOCK:
+        _MODELS.clear()
+        _TOKENIZERS.clear()
+
+
+def export(model_class, path, out_dir):
+    """Save ``path`` as config + ``model.safetensors`` under ``out_dir``, the layout ``set_checkpoint_dir`` expects."""
+    from safetensors.torch import save_file
+
+    target = os.path.join(out_dir, path.replace('/', '--'))
+    model = model_class.from_pretrained(path)
+    model.config.save_pretrained(target)
+    state, seen = {}, set()
+    for name, tensor in model.state_dict().items():
+        # safetensors refuses aliased storage, so keep only the first name of tied weights
+        if tensor.data_ptr() in seen:
+            continue
+        seen.add(tensor.data_ptr())
+        state[name] = tensor.contiguous()
+    save_file(state, os.path.join(target, SAFETENSORS_NAME))
+    return target
+
+
+if __name__ == '__main__':
+    import transformers
+
+    parser = argparse.ArgumentParser(description="export checkpoints as memory-mappable safetensors")
+    parser.add_argument("--out_dir", type=str, required=True)
+    parser.add_argument("models", type=str, nargs='*', default=DEFAULT_EXPORTS, help="ModelClass=hub_path pairs")
+    args = parser.parse_args()
+
+    for spec in args.models:
+        class_name, path = spec.split('=', 1)
+        print('exported {} to {}'.format(path, export(getattr(transformers, class_name), path, args.out_dir)))
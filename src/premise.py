@@ -0,0 +1,60 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict, namedtuple
+
+from src.utils import formalize_tA
+
+# every entity placeholder spelling found in the datasets and in generated rules
+MASK_PATTERN = re.compile(r'<mask>|<A>|<B>|\[X\]|\[Y\]|<ent0>|<ent1>', re.IGNORECASE)
+
+# text: what the models see; key: the case- and spacing-insensitive identity; hash: digest of key
+Premise = namedtuple('Premise', ['text', 'key', 'hash'])
+
+
+def normalize(premise):
+    """Model input for ``premise``: the old ``prepare_premise`` output, after unifying placeholders and runs of whitespace."""
+    tA = MASK_PATTERN.sub('<mask>', premise)
+    tA = ' '.join(tA.split())
+    tA = formalize_tA(tA)
+    return tA.replace('<mask>', ' <mask> ').replace('  ', ' ')
+
+
+def copy_rules(rules):
+    # rules are strings or, with scores, [text, score] lists that callers may update in place
+    return [list(rule) if isinstance(rule, list) else rule for rule in rules]
+
+
+def canonicalize(premise):
+    text = normalize(premise)
+    key = ' '.join(text.casefold().split())
+    return Premise(text, key, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+class ResultCache(object):
+    """Thread-safe LRU map; ``max_size=0`` disables it."""
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return copy_rules(self.entries[key])
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = copy_rules(value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,33 @@
+from contextlib import contextmanager
+
+import torch
+
+from src.model_registry import is_cuda
+
+
+def device_index(device):
+    device = torch.device(device)
+    return device.index if device.index is not None else torch.cuda.current_device()
+
+
+@contextmanager
+def seeded(seed, device='cpu'):
+    """Run the block with the CPU and ``device`` RNGs seeded to ``seed``.
+
+    The previous RNG states are restored on exit, so a seeded request neither
+    depends on nor disturbs the random state of the requests around it.
+    ``generate`` in transformers draws from the global torch RNGs, so this
+    relies on requests being executed one at a time on the model thread, as
+    ``server.BatchingWorker`` and ``AsyncInductor`` do. ``seed=None`` is a
+    no-op.
+    """
+    if seed is None:
+        yield
+        return
+    devices = [device_index(device)] if is_cuda(device) else []
+    with torch.random.fork_rng(devices=devices):
+        torch.default_generator.manual_seed(seed)
+        for index in devices:
+            with torch.cuda.device(index):
+                torch.cuda.manual_seed(seed)
+        yield
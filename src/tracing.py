@@ -0,0 +1,161 @@
+import json
+import logging
+import os
+import resource
+import time
+import uuid
+from contextlib import contextmanager
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class NullTracer(object):
+    """Default tracer: every hook is a no-op so uninstrumented runs pay nothing."""
+
+    @contextmanager
+    def request(self, **meta):
+        yield None
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def count(self, name, n=1):
+        pass
+
+
+NULL_TRACER = NullTracer()
+
+
+class Tracer(NullTracer):
+    """Per-request stage timers and counters.
+
+    Each ``request`` produces one trace dict::
+
+        {'id', 'meta', 'start', 'duration',
+         'stages': [{'name', 'depth', 'offset', 'duration', ('peak_memory_mb' | 'max_rss_mb')}],
+         'counters': {name: value}}
+
+    and hands it to ``sink``: a callable, the path of a JSON-lines file, or
+    ``None`` to log it at INFO level. ``device`` is the device the traced
+    models run on; on a CUDA device stages are synchronized with it and,
+    with ``memory``, record ``peak_memory_mb``, the most memory allocated on
+    it while that stage (or request) ran. On CPU only the process's lifetime
+    high-water mark is available, recorded as ``max_rss_mb``.
+    ``profile_dir`` additionally captures a torch profiler chrome trace per
+    request, named after the trace id.
+    The tracer keeps one active request at a time, so share it only between
+    callers that run requests serially.
+    """
+
+    def __init__(self, sink=None, device='cpu', sync_cuda=True, memory=False, profile_dir=None):
+        self.sink = sink
+        self.device = torch.device(device)
+        self.cuda = self.device.type == 'cuda'
+        self.sync_cuda = sync_cuda and self.cuda
+        self.memory = memory
+        self.profile_dir = profile_dir
+        self.trace = None
+        self.last_trace = None
+        self.depth = 0
+        self.start = None
+        self.profiler = None
+        # running CUDA peak of every open request / stage, innermost last
+        self.peaks = []
+
+    def sync(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize(self.device)
+
+    def enter_memory(self):
+        if not (self.memory and self.cuda):
+            return
+        # fold the allocator's peak so far into the enclosing scope, then measure this scope from zero
+        if self.peaks:
+            self.peaks[-1] = max(self.peaks[-1], torch.cuda.max_memory_allocated(self.device))
+        torch.cuda.reset_peak_memory_stats(self.device)
+        self.peaks.append(0)
+
+    def exit_memory(self, record):
+        if not self.memory:
+            return
+        if not self.cuda:
+            record['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+            return
+        peak = max(self.peaks.pop(), torch.cuda.max_memory_allocated(self.device))
+        if self.peaks:
+            self.peaks[-1] = max(self.peaks[-1], peak)
+        record['peak_memory_mb'] = peak / 2 ** 20
+
+    @contextmanager
+    def request(self, **meta):
+        if self.trace is not None:
+            # nested request (e.g. generate inside generate_batch): fold into the outer trace
+            yield self.trace
+            return
+
+        self.sync()
+        self.enter_memory()
+        self.trace = {'id': uuid.uuid4().hex, 'meta': meta, 'start': time.time(), 'stages': [], 'counters': {}}
+        self.start = time.perf_counter()
+        if self.profile_dir is not None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities)
+            self.profiler.__enter__()
+        try:
+            yield self.trace
+        finally:
+            self.sync()
+            trace = self.trace
+            trace['duration'] = time.perf_counter() - self.start
+            self.exit_memory(trace)
+            if self.profiler is not None:
+                self.profiler.__exit__(None, None, None)
+                if not os.path.exists(self.profile_dir):
+                    os.makedirs(self.profile_dir)
+                self.profiler.export_chrome_trace(os.path.join(self.profile_dir, trace['id'] + '.json'))
+                self.profiler = None
+            self.trace = None
+            self.last_trace = trace
+            self.emit(trace)
+
+    @contextmanager
+    def stage(self, name):
+        if self.trace is None:
+            yield
+            return
+
+        self.sync()
+        record = {'name': name, 'depth': self.depth, 'offset': time.perf_counter() - self.start}
+        self.enter_memory()
+        start = time.perf_counter()
+        self.depth += 1
+        try:
+            if self.profiler is not None:
+                with torch.autograd.profiler.record_function(name):
+                    yield
+            else:
+                yield
+        finally:
+            self.sync()
+            self.depth -= 1
+            record['duration'] = time.perf_counter() - start
+            self.exit_memory(record)
+            self.trace['stages'].append(record)
+
+    def count(self, name, n=1):
+        if self.trace is not None:
+            self.trace['counters'][name] = self.trace['counters'].get(name, 0) + n
+
+    def emit(self, trace):
+        if callable(self.sink):
+            self.sink(trace)
+        elif self.sink is not None:
+            with open(self.sink, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(trace) + '\n')
+        else:
+            logger.info(json.dumps(trace))
@@ -0,0 +1,207 @@
+import json
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+STRINGS = 'strings.jsonl'
+
+
+def merge_counts(parts):
+    """Sum the counts of equal rows over ``parts``, a list of (triples, counts) arrays; rows come back sorted."""
+    parts = [(triples, counts) for triples, counts in parts if len(triples) > 0]
+    if not parts:
+        return np.zeros((0, 3), dtype=np.int32), np.zeros(0, dtype=np.int64)
+    triples = np.concatenate([np.asarray(triples) for triples, _ in parts])
+    counts = np.concatenate([np.asarray(counts) for _, counts in parts])
+    order = np.lexsort((triples[:, 2], triples[:, 1], triples[:, 0]))
+    triples, counts = triples[order], counts[order]
+    first = np.ones(len(triples), dtype=bool)
+    first[1:] = np.any(triples[1:] != triples[:-1], axis=1)
+    starts = np.nonzero(first)[0]
+    return triples[starts], np.add.reduceat(counts, starts)
+
+
+class TripleStore(object):
+    """Interned, deduplicated (subject, verb, object) triples.
+
+    On disk the store is an append-only string table (``strings.jsonl``, one
+    JSON string per line) plus numpy arrays: a compacted base (``triples``,
+    N x 3 int32 string ids, and ``counts``, N int64 frequencies) and one
+    delta pair per shard added since the last compaction. ``manifest.json``
+    is the commit point: it records the completed shards, the number of
+    valid strings, the base generation and the live deltas, and is replaced
+    only after those files are fully written, so an interrupted run resumes
+    from the last finished shard. Adding a shard costs memory and I/O in the
+    size of the shard; ``compact`` (every ``compact_every`` shards, and once
+    at the end) folds the deltas into a new base.
+    """
+
+    def __init__(self, path, compact_every=32):
+        self.path = path
+        self.compact_every = compact_every
+        self.strings = []
+        self.string_ids = {}
+        self.done_shards = set()
+        self.generation = 0
+        self.deltas = []
+        self.next_delta = 0
+        self.num_triples = 0
+        self.skipped = 0
+        if not os.path.exists(path):
+            os.makedirs(path)
+        if os.path.exists(os.path.join(path, MANIFEST)):
+            self.load()
+
+    def intern(self, string):
+        if string not in self.string_ids:
+            self.string_ids[string] = len(self.strings)
+            self.strings.append(string)
+        return self.string_ids[string]
+
+    def is_done(self, shard):
+        return shard in self.done_shards
+
+    def add_shard(self, shard, triples):
+        """Commit the triples of ``shard``; returns how many were skipped for not having three parts."""
+        num_strings = len(self.strings)
+        counts = {}
+        skipped = 0
+        for t in triples:
+            if len(t) != 3:
+                skipped += 1
+                continue
+            key = tuple(self.intern(part) for part in t)
+            counts[key] = counts.get(key, 0) + 1
+        if skipped:
+            logger.warning("{}: skipped {} malformed triples".format(shard, skipped))
+
+        with open(os.path.join(self.path, STRINGS), 'a', encoding='utf-8') as f:
+            for string in self.strings[num_strings:]:
+                f.write(json.dumps(string, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        keys = sorted(counts.keys())
+        delta = self.next_delta
+        np.save(self._file('delta-triples', delta), np.array(keys, dtype=np.int32).reshape(-1, 3))
+        np.save(self._file('delta-counts', delta), np.array([counts[key] for key in keys], dtype=np.int64))
+
+        self.done_shards.add(shard)
+        self.deltas.append(delta)
+        self.next_delta = delta + 1
+        self.skipped += skipped
+        self.write_manifest()
+        if self.compact_every is not None and len(self.deltas) >= self.compact_every:
+            self.compact()
+        return skipped
+
+    def compact(self):
+        """Fold the deltas into a new base generation."""
+        if not self.deltas:
+            return
+        triples, counts, _, _ = load_triples(self.path, mmap=True)
+        generation = self.generation + 1
+        np.save(self._file('triples', generation), triples)
+        np.save(self._file('counts', generation), counts)
+        old_generation, old_deltas = self.generation, self.deltas
+        self.generation, self.deltas, self.num_triples = generation, [], len(triples)
+        self.write_manifest()
+
+        for name in ('triples', 'counts'):
+            old = self._file(name, old_generation)
+            if os.path.exists(old):
+                os.remove(old)
+        for delta in old_deltas:
+            for name in ('delta-triples', 'delta-counts'):
+                os.remove(self._file(name, delta))
+
+    def _file(self, name, number):
+        return os.path.join(self.path, '{}-{}.npy'.format(name, number))
+
+    def write_manifest(self):
+        manifest = {
+            'generation': self.generation,
+            'deltas': self.deltas,
+            'next_delta': self.next_delta,
+            'shards': sorted(self.done_shards),
+            'num_triples': self.num_triples,
+            'num_strings': len(self.strings),
+            'skipped': self.skipped,
+        }
+        tmp = os.path.join(self.path, MANIFEST + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp, os.path.join(self.path, MANIFEST))
+
+    def load(self):
+        manifest = read_manifest(self.path)
+        self.generation = manifest['generation']
+        self.deltas = manifest['deltas']
+        self.next_delta = manifest['next_delta']
+        self.done_shards = set(manifest['shards'])
+        self.num_triples = manifest['num_triples']
+        self.skipped = manifest['skipped']
+        self.strings = read_strings(self.path, manifest['num_strings'], truncate=True)
+        self.string_ids = {s: i for i, s in enumerate(self.strings)}
+
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def read_strings(path, num_strings, truncate=False):
+    """The first ``num_strings`` strings; ``truncate`` also cuts off strings of an uncommitted shard."""
+    strings = []
+    if num_strings == 0:
+        return strings
+    with open(os.path.join(path, STRINGS), 'rb') as f:
+        while len(strings) < num_strings:
+            strings.append(json.loads(f.readline().decode('utf-8')))
+        end = f.tell()
+    if truncate and os.path.getsize(os.path.join(path, STRINGS)) > end:
+        with open(os.path.join(path, STRINGS), 'r+b') as f:
+            f.truncate(end)
+    return strings
+
+
+def load_triples(path, mmap=True):
+    """Return (triples, counts, strings, manifest) for the store at ``path``.
+
+    A compacted store is memory-mapped (with ``mmap``); pending deltas are
+    merged into the base in memory.
+    """
+    manifest = read_manifest(path)
+    generation = manifest['generation']
+    mmap_mode = 'r' if mmap else None
+    parts = []
+    if manifest['num_triples'] > 0:
+        parts.append((np.load(os.path.join(path, 'triples-{}.npy'.format(generation)), mmap_mode=mmap_mode),
+                      np.load(os.path.join(path, 'counts-{}.npy'.format(generation)), mmap_mode=mmap_mode)))
+    for delta in manifest['deltas']:
+        parts.append((np.load(os.path.join(path, 'delta-triples-{}.npy'.format(delta))),
+                      np.load(os.path.join(path, 'delta-counts-{}.npy'.format(delta)))))
+    if len(parts) == 1:
+        triples, counts = parts[0]
+    else:
+        triples, counts = merge_counts(parts)
+    strings = read_strings(path, manifest['num_strings'])
+    return triples, counts, strings, manifest
+
+
+def find_triples(path, subject=None, verb=None, obj=None):
+    """Yield ([subject, verb, object], count) for triples matching the given strings."""
+    triples, counts, strings, _ = load_triples(path)
+    string_ids = {s: i for i, s in enumerate(strings)}
+    mask = np.ones(triples.shape[0], dtype=bool)
+    for column, value in enumerate((subject, verb, obj)):
+        if value is None:
+            continue
+        if value not in string_ids:
+            return
+        mask &= triples[:, column] == string_ids[value]
+    for index in np.nonzero(mask)[0]:
+        yield [strings[i] for i in triples[index]], int(counts[index])
@@ -8,3 +8,13 @@ generated_texts = inductor.generate(rule, k=10, topk=10)
 print('output generated rules:')
 for text in generated_texts:
     print(text)
+
+# a seeded batch gives the same rules with and without scores
+texts = inductor.generate_batch([rule], k=10, topk=10, seed=42)[0]
+scored = inductor.generate_batch([rule], k=10, topk=10, seed=42, with_scores=True)[0]
+assert [text for text, _ in scored] == texts, (scored, texts)
+assert all(isinstance(score, float) for _, score in scored), scored
+
+print('output generated rules with scores:')
+for text, score in scored:
+    print('{:.4f}\t{}'.format(score, text))
@@ -1,46 +1,249 @@
-import re
+import argparse
+import copy
+import logging
+import math
+import os
+import random
 import torch
 from torch.optim import Adam
 import numpy as np
-from dpp_sampler import DPPsampler
+from dpp_sampler import DPPsampler, PROJECTION_NAME
+from src.data_reader import read_rule_records, set_cache_dir
+
+logger = logging.getLogger(__name__)
+
+# kernels whose smallest eigenvalue is below this fraction of the largest are treated as singular
+SINGULAR_EPS = 1e-6
+
 
 def clean_references(texts):
     for i, text in enumerate(texts):
         if text.endswith(" ."):
             texts[i] = text.replace(" .", ".")
-    
+
     return texts
 
+
+def load_reference_sets(path):
+    ref = []
+    for record in read_rule_records(path):
+        if record.is_list:
+            references = [relation.replace('<A>', 'A').replace('<B>', 'B').lower().strip() for relation in record.relations]
+        else:
+            references = [record.relations[0].replace('[X]', '<mask>').replace('[Y]', '<mask>').lower().strip()]
+        references = clean_references(references)
+        # a repeated reference makes the set's kernel singular
+        references = list(dict.fromkeys(references))
+
+        if len(references) > 1:
+            ref.append([[r, 1] for r in references])
+    return ref
+
+
+class SetEncoder(object):
+    """Kernel features (see ``DPPsampler.get_features``) for batches of reference sets.
+
+    ``freeze='none'`` runs the whole encoder on every step. ``'bottom'``
+    freezes the embeddings and the first ``frozen_layers`` BERT layers and
+    caches their output per reference set, so a step only runs the layers
+    above. ``'head'`` freezes the encoder, caches every set's pooled
+    representation and trains a linear projection on top (saved as
+    ``projection.pt``, which ``DPPsampler`` picks up), so a step is a small
+    matmul. Cached activations live on the CPU.
+    """
+
+    def __init__(self, sampler, freeze='none', frozen_layers=6, amp=False):
+        self.sampler = sampler
+        self.freeze = freeze
+        self.frozen_layers = frozen_layers
+        self.amp = amp
+        self.cache = {}
+        model = sampler.model
+        if freeze == 'bottom':
+            for module in [model.embeddings] + list(model.encoder.layer[:frozen_layers]):
+                module.requires_grad_(False)
+        elif freeze == 'head':
+            model.requires_grad_(False)
+            hidden_size = model.config.hidden_size
+            sampler.projection = torch.nn.Linear(hidden_size, hidden_size).to(sampler.device)
+            # start from the untrained kernel
+            with torch.no_grad():
+                sampler.projection.weight.copy_(torch.eye(hidden_size))
+                sampler.projection.bias.zero_()
+        elif freeze != 'none':
+            raise ValueError('unknown freeze mode {}'.format(freeze))
+
+    def parameters(self):
+        if self.freeze == 'head':
+            return list(self.sampler.projection.parameters())
+        return [p for p in self.sampler.model.parameters() if p.requires_grad]
+
+    def cached(self, sents):
+        key = tuple(sent[0] for sent in sents)
+        if key not in self.cache:
+            with torch.no_grad(), torch.cuda.amp.autocast(enabled=self.amp):
+                if self.freeze == 'head':
+                    value = self.sampler.get_repr(sents)
+                else:
+                    # same unmasked, per-set padded input as get_repr
+                    ids = torch.tensor(self.sampler.tokenize(sents, self.sampler.tokenizer)).to(self.sampler.device)
+                    value = self.sampler.model.embeddings(input_ids=ids)
+                    for layer in self.sampler.model.encoder.layer[:self.frozen_layers]:
+                        value = layer(value)[0]
+            self.cache[key] = value.float().cpu()
+        return self.cache[key].to(self.sampler.device)
+
+    def __call__(self, sets):
+        with torch.cuda.amp.autocast(enabled=self.amp):
+            reprs = []
+            for sents in sets:
+                if self.freeze == 'none':
+                    # one get_repr call per set: its padding is pooled, so batching sets together would change their kernels
+                    reprs.append(self.sampler.get_repr(sents))
+                    continue
+                value = self.cached(sents)
+                if self.freeze == 'bottom':
+                    for layer in self.sampler.model.encoder.layer[self.frozen_layers:]:
+                        value = layer(value)[0]
+                    value = torch.mean(value, dim=1)
+                reprs.append(value)
+            scores = torch.tensor([sent[1] for sents in sets for sent in sents]).to(self.sampler.device)
+            return self.sampler.kernel_features(torch.cat(reprs, dim=0), scores)
+
+
+def batch_log_likelihood(encoder, sets):
+    """log det(L) - log det(L + I) of every reference set, each set being its own ground set.
+
+    The kernels are padded to the largest set with identity blocks, which leaves det(L)
+    unchanged and multiplies det(L + I) by 2 per padded row, so that factor is
+    subtracted again. Determinants use slogdet in float64; singular and
+    near-singular sets (smallest eigenvalue below ``SINGULAR_EPS`` times the
+    largest, e.g. duplicated references) come back as -inf.
+    """
+    sizes = [len(s) for s in sets]
+    B_all, scores_all = encoder(sets)
+    B_all = B_all.double()
+    scores_all = scores_all.double()
+
+    n = max(sizes)
+    set_ids = torch.cat([torch.full((size,), i, dtype=torch.long) for i, size in enumerate(sizes)]).to(B_all.device)
+    positions = torch.cat([torch.arange(size) for size in sizes]).to(B_all.device)
+    B = B_all.new_zeros((len(sets), n, B_all.size(1)))
+    B[set_ids, positions] = B_all
+    diag = B_all.new_ones((len(sets), n))
+    diag[set_ids, positions] = scores_all
+
+    # padded rows of B are zero, so only the diagonal needs fixing: s_i for real rows, 1 for padding
+    L = torch.bmm(B, B.transpose(1, 2))
+    L = L - torch.diag_embed(L.diagonal(dim1=1, dim2=2)) + torch.diag_embed(diag)
+    eye = torch.eye(n, dtype=L.dtype, device=L.device)
+    padding = torch.tensor([n - size for size in sizes], dtype=L.dtype, device=L.device)
+
+    # slogdet's backward is NaN on singular inputs even when masked out later, so swap them for I first
+    with torch.no_grad():
+        eigenvalues = torch.linalg.eigvalsh(L)
+        singular = eigenvalues[:, 0] <= SINGULAR_EPS * eigenvalues[:, -1].clamp(min=1.0)
+    L = torch.where(singular[:, None, None], eye.expand_as(L), L)
+    loglik = torch.slogdet(L)[1] - (torch.slogdet(L + eye)[1] - padding * math.log(2))
+    return torch.where(singular, torch.full_like(loglik, -float('inf')), loglik)
+
+
+def evaluate(encoder, sets, batch_size):
+    losses = []
+    with torch.no_grad():
+        for start in range(0, len(sets), batch_size):
+            loglik = batch_log_likelihood(encoder, sets[start:start + batch_size])
+            losses.extend((-loglik[torch.isfinite(loglik)]).tolist())
+    return float(np.mean(losses)) if len(losses) > 0 else float('inf')
+
+
+def save(sampler, path):
+    # DPPsampler(device, model_dir=path) loads both back
+    sampler.model.save_pretrained(path)
+    sampler.tokenizer.save_pretrained(path)
+    if sampler.projection is not None:
+        torch.save(sampler.projection.state_dict(), os.path.join(path, PROJECTION_NAME))
+
+
 if __name__ == "__main__":
-    model_dir = "./model/dpp_encoder/"
-    sampler = DPPsampler(0)
-    optimizer = Adam(sampler.model.parameters(), lr=1e-6)
-    
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default='0')
+    parser.add_argument("--data_files", type=str, nargs='+', default=['./data/OpenRule155.txt'])
+    parser.add_argument("--output_dir", type=str, default='./model/dpp_encoder/')
+    parser.add_argument("--epochs", type=int, default=1000)
+    parser.add_argument("--batch_size", type=int, default=10, help="reference sets per optimizer step")
+    parser.add_argument("--lr", type=float, default=1e-6)
+    parser.add_argument("--valid_ratio", type=float, default=0.1)
+    parser.add_argument("--patience", type=int, default=10, help="stop after this many epochs without validation improvement")
+    parser.add_argument("--save_every", type=int, default=50, help="also keep a checkpoint every n epochs")
+    parser.add_argument("--amp", action='store_true', help="run the encoder under CUDA mixed precision")
+    parser.add_argument("--freeze", type=str, default='none', choices=['none', 'bottom', 'head'],
+                        help="bottom: freeze and cache the lower layers; head: freeze BERT and train a projection over cached embeddings")
+    parser.add_argument("--frozen_layers", type=int, default=6, help="BERT layers frozen by --freeze bottom")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--data_cache", type=str, default=None, help="directory for parsed copies of the data files, see src/data_reader.py")
+    args = parser.parse_args()
+    if args.data_cache is not None:
+        set_cache_dir(args.data_cache)
+
+    logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+        datefmt='%m/%d/%Y %H:%M:%S',
+        level=logging.INFO)
+
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    device = args.device if args.device == 'cpu' else 'cuda:' + args.device
+    amp = args.amp and device != 'cpu'
+    sampler = DPPsampler(device, quantize=False)
+    # the model registry shares its models read-only, so train a private copy; safetensors-mapped checkpoints
+    # are also loaded frozen
+    sampler._model = copy.deepcopy(sampler.model)
+    sampler.model.requires_grad_(True)
+    encoder = SetEncoder(sampler, args.freeze, args.frozen_layers, amp)
+    optimizer = Adam(encoder.parameters(), lr=args.lr)
+    scaler = torch.cuda.amp.GradScaler(enabled=amp)
+
     ref = []
-    with open('./data/OpenRule155.txt', 'r', encoding='utf-8') as file:
-        data = file.readlines()
-        for row in data:
-            row = row.strip().split('\t')
-            inputs, head, tail, relations = row[0], row[1], row[2], row[3]
-            inputs = inputs.strip()
-            
-            if relations.startswith('[') and relations.endswith(']'):
-                inputs = re.sub("<A>|<B>", "<mask>", inputs)
-                references = [relation.replace('<A>', 'A').replace('<B>', 'B').lower().strip() for relation in eval(relations)]
-            else:
-                references = [relations.replace('[X]', '<mask>').replace('[Y]', '<mask>').lower().strip()]
-            references = clean_references(references)
-            
-            if len(references) > 1:
-                ref.append([[r, 1] for r in references])
-    
-    for e in range(1000):
-        batch_size = 10
-        for r in ref:
+    for path in args.data_files:
+        ref.extend(load_reference_sets(path))
+    random.shuffle(ref)
+    num_valid = int(len(ref) * args.valid_ratio)
+    valid, train = ref[:num_valid], ref[num_valid:]
+    logger.info("{} training / {} validation reference sets".format(len(train), len(valid)))
+
+    best = float('inf')
+    bad_epochs = 0
+    for e in range(args.epochs):
+        random.shuffle(train)
+        losses = []
+        skipped = 0
+        for start in range(0, len(train), args.batch_size):
+            loglik = batch_log_likelihood(encoder, train[start:start + args.batch_size])
+            finite = torch.isfinite(loglik)
+            skipped += int((~finite).sum())
+            if not finite.any():
+                continue
+            loss = -loglik[finite].mean()
+
             optimizer.zero_grad()
-            L = sampler.get_L(r)
-            loss = -torch.log(torch.det(L)/torch.det(L+torch.eye(L.shape[0]).cuda(0)))
-            
-            loss.backward()
-            optimizer.step()
-            print(loss)
\ No newline at end of file
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            losses.append(loss.item())
+
+        train_loss = float(np.mean(losses)) if len(losses) > 0 else float('inf')
+        valid_loss = evaluate(encoder, valid, args.batch_size) if len(valid) > 0 else train_loss
+        logger.info("epoch {}: train loss {:.4f}, valid loss {:.4f}, {} singular sets skipped".format(e, train_loss, valid_loss, skipped))
+
+        if args.save_every > 0 and (e + 1) % args.save_every == 0:
+            save(sampler, os.path.join(args.output_dir, 'checkpoint-{}'.format(e + 1)))
+        if valid_loss < best:
+            best = valid_loss
+            bad_epochs = 0
+            save(sampler, args.output_dir)
+        else:
+            bad_epochs += 1
+            if bad_epochs >= args.patience:
+                logger.info("no improvement for {} epochs, stopping; best valid loss {:.4f}".format(args.patience, best))
+                break
@@ -1,6 +1,7 @@
 import os
 import tqdm
 from extractor.subject_verb_object_extract import findSVOs, nlp
+from src.triple_store import TripleStore
 
 def extract(str):
     tokens = nlp(str)
@@ -10,20 +11,23 @@ def extract(str):
     return svos
 
 datadir = './data/wiki/wiki_doc/docs/AB/'
-outdir = './data/wiki/wiki_doc/docs/AB_out/'
-if not os.path.exists(outdir):
-    os.makedirs(outdir)
-svo = []
-for filename in os.listdir(datadir):
+outdir = './data/wiki/wiki_doc/docs/AB_store/'
+store = TripleStore(outdir)
+for filename in sorted(os.listdir(datadir)):
+    if store.is_done(filename):
+        print("skipping " + filename + " (already processed)")
+        continue
     path = datadir + filename
     print("processing " + path)
+    svo = []
     with open(path) as f:
-        lines = f.readlines()
-        for line in tqdm.tqdm(lines):
+        for line in tqdm.tqdm(f):
             t = extract(line)
             if t is not None:
                 svo.extend(t)
 
-    with open(outdir + filename, 'w') as g:
-        for t in svo:
-            g.writelines('\t'.join(t) + '\n')
\ No newline at end of file
+    skipped = store.add_shard(filename, svo)
+    print("{} triples ({} malformed skipped), {} strings".format(len(svo), skipped, len(store.strings)))
+
+store.compact()
+print("{} unique triples, {} strings".format(store.num_triples, len(store.strings)))